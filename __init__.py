@@ -50,10 +50,32 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import cache
+from . import metrics
+from . import jsonstream
+from . import records
+from . import trelloclient
+from . import boardsync
+from . import render
+from . import cardindex
+from . import outqueue
+from . import statestore
+from . import shards
 from . import plugin
 from imp import reload
 # In case we're being reloaded.
 reload(config)
+reload(cache)
+reload(metrics)
+reload(jsonstream)
+reload(records)
+reload(trelloclient)
+reload(boardsync)
+reload(render)
+reload(cardindex)
+reload(outqueue)
+reload(statestore)
+reload(shards)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
@@ -0,0 +1,310 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Offline benchmarks for TrelloMon.  Everything runs against stubtrello, so no
+network access or Trello credentials are needed:
+
+    python benchmark.py
+
+These time the building blocks on their own, and compare the peak memory
+of fetching a large list as plain json and as streamed compact cards.  The cost of whole check cycles
+of the plugin, as lists, cards, channels and networks grow, is measured by
+TrelloMonBenchmark in test.py:
+
+    TRELLOMON_BENCHMARK=1 supybot-test TrelloMon
+"""
+
+import re
+import resource
+import subprocess
+import sys
+import time
+
+from render import CardSet, CustomFilter, LabelMatcher, Template
+from stubtrello import StubTrello
+from trelloclient import CARD_FIELDS, RateLimiter, TrelloClient
+
+
+def _client(stub, **kwargs):
+    '''a client for the stub that is not held back by trello's rate limit'''
+    return TrelloClient('key', 'token', stub.url,
+                        limiter=RateLimiter(limit=10 ** 9), **kwargs)
+
+
+def _timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def bench_fetch(sizes=(10, 100, 1000)):
+    '''requests and wall time to fetch one list, per-card vs batched'''
+    print('list fetch: per-card customFieldItems vs inline')
+    print('%8s %10s %10s %10s %10s' % ('cards', 'percard', 'secs',
+                                       'inline', 'secs'))
+    for size in sizes:
+        stub = StubTrello().start()
+        try:
+            stub.add_board('board', {'list': size})
+            row = [size]
+            for percard in (True, False):
+                stub.reset()
+                client = _client(stub)
+                _, secs = _timed(client.fetch_list, 'list', percard=percard)
+                row.extend([len(stub.requests), secs])
+            print('%8d %10d %10.3f %10d %10.3f' % tuple(row))
+        finally:
+            stub.stop()
+
+
+def bench_concurrency(lists=8, cards=100, latency=0.05, workers=(1, 4, 8)):
+    '''wall time to fetch lists on separate boards with a slow trello'''
+    print('fetch %d lists of %d cards, %.2fs latency per request' %
+          (lists, cards, latency))
+    print('%8s %10s %10s' % ('workers', 'requests', 'secs'))
+    stub = StubTrello(latency=latency).start()
+    try:
+        listids = ['list%d' % n for n in range(lists)]
+        for listid in listids:
+            stub.add_board('board-' + listid, {listid: cards})
+        for concurrency in workers:
+            stub.reset()
+            client = _client(stub, concurrency=concurrency)
+            _, secs = _timed(client.fetch_lists, listids)
+            client.close()
+            print('%8d %10d %10.3f' % (concurrency, len(stub.requests), secs))
+    finally:
+        stub.stop()
+
+
+def _legacy_value(field, custom_field_info):
+    for cf in custom_field_info:
+        if field['idCustomField'] == cf['id']:
+            if cf['type'] == 'list':
+                for option in cf['options']:
+                    if option['id'] == field['idValue']:
+                        return str(option['value']['text'])
+            elif cf['type'] == 'text':
+                return str(field['value']['text'])
+            elif cf['type'] == 'checkbox':
+                return str(field['value']['checked'])
+    return None
+
+
+def _legacy_deref(basestr, custom_info, card):
+    '''the per-call regex and linear scans templates used to go through'''
+    p = re.compile(r'\${\w+}')
+    for match in p.finditer(basestr):
+        variable = match.group()[2:-1]
+        custom_field = None
+        for field in custom_info:
+            if field['name'] == variable:
+                custom_field = field
+                break
+        if custom_field is None:
+            basestr = basestr.replace(match.group(), "N/A")
+        else:
+            value = None
+            for entry in card['customFieldItems']:
+                if entry['idCustomField'] == custom_field['id']:
+                    value = _legacy_value(entry, custom_info)
+            basestr = basestr.replace(match.group(), str(value))
+    return basestr
+
+
+def bench_render(cards=1000, channels=20):
+    '''cost of rendering precustom and postcustom for every card and
+    channel'''
+    stub = StubTrello()
+    stub.add_board('board', {'list': cards})
+    board = stub.boards['board']
+    # pad the board to a realistic number of custom fields
+    fields = board['customFields'] + [
+        {'id': 'extra%d' % n, 'name': 'Extra%d' % n, 'type': 'text'}
+        for n in range(20)]
+    listcards = stub.lists['list']['cards']
+    pre = 'DFG: ${DFG} ${Extra19}'
+    post = 'RCA: ${RCA} blocker: ${Blocker} ${Missing}'
+    print('render %d cards x %d channels' % (cards, channels))
+
+    def legacy():
+        for chan in range(channels):
+            for card in listcards:
+                _legacy_deref(pre, fields, card)
+                _legacy_deref(post, fields, card)
+
+    def planned():
+        cardset = CardSet(listcards, fields)
+        pretemplate = Template(pre)
+        posttemplate = Template(post)
+        for chan in range(channels):
+            for (card, values, labels) in cardset:
+                pretemplate.render(cardset.fields, values)
+                posttemplate.render(cardset.fields, values)
+
+    for (name, func) in (('legacy', legacy), ('planned', planned)):
+        _, secs = _timed(func)
+        print('%8s %10.3f secs %8.2f us/card/channel' %
+              (name, secs, secs * 1e6 / (cards * channels)))
+
+
+def _legacy_filter(card, custom_filter, custom_field_info):
+    '''the per-card parse and scans custom_field_filter used to go
+    through.  True means the card is filtered out.'''
+    for criteria in custom_filter.split(','):
+        (field_name, value) = criteria.split(':', 1)
+        for cf in custom_field_info:
+            if cf['name'] == field_name:
+                break
+        for field in card['customFieldItems']:
+            if field['idCustomField'] == cf['id']:
+                if value == _legacy_value(field, custom_field_info):
+                    return False
+    return True
+
+
+def bench_filter(cards=1000, channels=50):
+    '''cost of applying a custom_field_filter to every card and channel'''
+    stub = StubTrello()
+    stub.add_board('board', {'list': cards})
+    fields = stub.boards['board']['customFields']
+    listcards = stub.lists['list']['cards']
+    text = 'DFG:Storage,Blocker:true'
+    print('filter %d cards x %d channels' % (cards, channels))
+
+    def legacy():
+        for chan in range(channels):
+            for card in listcards:
+                _legacy_filter(card, text, fields)
+
+    def compiled():
+        cardset = CardSet(listcards, fields)
+        custom_filter = CustomFilter(text)
+        for chan in range(channels):
+            for (card, values, labels) in cardset:
+                custom_filter.matches(cardset.fields, values)
+
+    for (name, func) in (('legacy', legacy), ('compiled', compiled)):
+        _, secs = _timed(func)
+        print('%8s %10.3f secs %8.2f us/card/channel' %
+              (name, secs, secs * 1e6 / (cards * channels)))
+
+
+def _legacy_labels(card_labels, valid_labels):
+    names = [label['name'] for label in card_labels]
+    for i in valid_labels:
+        for label in names:
+            if i.upper() in label.upper():
+                return True
+    return False
+
+
+def bench_labels(cards=1000, sizes=(1, 10, 100, 1000)):
+    '''per-card cost of the label filter as the label list grows.  The
+    patterns never match, which is the worst case for both.'''
+    stub = StubTrello()
+    stub.add_board('board', {'list': cards},
+                   labels=['DFG-%d' % n for n in range(20)])
+    stub.boards['board']['customFields'] = []
+    listcards = stub.lists['list']['cards']
+    cardset = CardSet(listcards, [])
+    print('label filter over %d cards' % cards)
+    print('%8s %14s %14s' % ('labels', 'legacy us/card', 'matcher us/card'))
+    for size in sizes:
+        patterns = ['squad-%d' % n for n in range(size)]
+        _, legacy = _timed(lambda: [_legacy_labels(card['labels'], patterns)
+                                    for card in listcards])
+        matcher = LabelMatcher(patterns)
+        _, compiled = _timed(lambda: [matcher.matches(labels)
+                                      for (card, values, labels) in cardset])
+        print('%8d %14.2f %14.2f' % (size, legacy * 1e6 / cards,
+                                     compiled * 1e6 / cards))
+
+
+def _peak_rss():
+    '''peak resident set size of this process in KiB.  ru_maxrss carries
+    over the peak of the parent across fork and exec, so linux's VmHWM is
+    read when there is one.'''
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _memory_run(mode, url):
+    '''fetch the list "big" from the stub at url, as the whole json
+    (mode json) or as streamed compact cards (mode compact), and print the
+    peak RSS before and after'''
+    client = TrelloClient('key', 'token', url,
+                          limiter=RateLimiter(limit=10 ** 9))
+    before = _peak_rss()
+    if mode == 'json':
+        cards = client.get('lists/big/cards', fields=CARD_FIELDS,
+                           customFieldItems='true')
+    else:
+        cards = client.get_list_cards('big')
+    print('%d %d %d' % (len(cards), before, _peak_rss()))
+
+
+def bench_memory(cards=5000):
+    '''peak RSS to fetch one large list, each way in a fresh process'''
+    print('peak RSS fetching a list of %d cards (KiB)' % cards)
+    print('%8s %10s %10s %10s' % ('parse', 'start', 'peak', 'growth'))
+    stub = StubTrello().start()
+    try:
+        stub.add_board('board', {'big': cards})
+        for mode in ('json', 'compact'):
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--memory', mode, stub.url])
+            (_, before, after) = [int(n) for n in out.split()]
+            print('%8s %10d %10d %10d' % (mode, before, after,
+                                          after - before))
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--memory']:
+        _memory_run(*sys.argv[2:4])
+        sys.exit()
+    bench_fetch()
+    bench_concurrency()
+    bench_render()
+    bench_filter()
+    bench_labels()
+    bench_memory()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,308 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Incremental card sync.  After one full load of the monitored lists of a
+board, only the board's actions since the last one seen are read and applied
+to an in-memory copy of its cards.  A quiet board then costs one small
+request per poll instead of a full card dump.  In webhook mode the actions
+are pushed to us instead and loaded boards are not polled at all.
+"""
+
+import threading
+import time
+
+from .records import compact_item, compact_label
+from .trelloclient import Snapshot
+
+# Board actions that can change what a monitored list contains
+ACTION_FILTER = ','.join(['createCard', 'copyCard',
+                          'convertToCardFromCheckItem', 'moveCardToBoard',
+                          'moveCardFromBoard', 'updateCard', 'deleteCard',
+                          'addLabelToCard', 'removeLabelFromCard',
+                          'updateLabel', 'deleteLabel',
+                          'updateCustomFieldItem'])
+
+# Trello returns at most this many actions per request.  Hitting the limit
+# means we may have missed some, so the board is loaded in full instead.
+ACTION_LIMIT = 1000
+
+# Actions that bring a card we know nothing about into a list
+NEW_CARD_ACTIONS = ('createCard', 'copyCard', 'convertToCardFromCheckItem',
+                    'moveCardToBoard')
+
+
+class Board(object):
+    '''the open cards of the monitored lists of one board'''
+
+    def __init__(self, boardid, lists):
+        self.id = boardid
+        self.lists = set(lists)
+        self.cards = {}
+        self.last_action = None
+        self.loaded = time.time()
+        self.lock = threading.Lock()
+
+    def list_cards(self, listid):
+        with self.lock:
+            cards = [card for card in self.cards.values()
+                     if card['idList'] == listid]
+        cards.sort(key=lambda card: card.get('pos', 0))
+        return cards
+
+    def apply(self, action, get_card):
+        '''update the cards from one board action.  get_card(id) is used
+        when a card shows up that we have no copy of.'''
+        with self.lock:
+            self._apply(action, get_card)
+            if self.last_action is None or action['id'] > self.last_action:
+                self.last_action = action['id']
+
+    def _apply(self, action, get_card):
+        kind = action['type']
+        data = action.get('data', {})
+        cardid = data.get('card', {}).get('id')
+        card = self.cards.get(cardid)
+        if kind in ('deleteCard', 'moveCardFromBoard'):
+            self.cards.pop(cardid, None)
+        elif kind in NEW_CARD_ACTIONS:
+            if data.get('list', {}).get('id') in self.lists:
+                self.cards[cardid] = get_card(cardid)
+        elif kind == 'updateCard':
+            new = data['card']
+            old = data.get('old', {})
+            listid = data.get('listAfter', {}).get('id') or \
+                new.get('idList') or data.get('list', {}).get('id')
+            if new.get('closed'):
+                self.cards.pop(cardid, None)
+            elif 'idList' in old or 'closed' in old:
+                # moved between lists, or taken out of the archive
+                if listid not in self.lists:
+                    self.cards.pop(cardid, None)
+                elif card is None or 'closed' in old:
+                    self.cards[cardid] = get_card(cardid)
+                else:
+                    card['idList'] = listid
+            elif card is not None:
+                for key in old:
+                    if key in new and key in card:
+                        card[key] = new[key]
+        elif kind == 'updateLabel':
+            # labels are shared between cards, so a changed one is replaced
+            label = data['label']
+            for each in self.cards.values():
+                each['labels'] = [compact_label(dict(existing, **label))
+                                  if existing['id'] == label['id']
+                                  else existing
+                                  for existing in each['labels']]
+        elif kind == 'deleteLabel':
+            for each in self.cards.values():
+                each['labels'] = [l for l in each['labels']
+                                  if l['id'] != data['label']['id']]
+        elif card is None:
+            return
+        elif kind == 'addLabelToCard':
+            label = data['label']
+            if label['id'] not in [l['id'] for l in card['labels']]:
+                card['labels'].append(compact_label(label))
+        elif kind == 'removeLabelFromCard':
+            card['labels'] = [l for l in card['labels']
+                              if l['id'] != data['label']['id']]
+        elif kind == 'updateCustomFieldItem':
+            item = data['customFieldItem']
+            items = [i for i in card['customFieldItems']
+                     if i['idCustomField'] != item['idCustomField']]
+            if item.get('idValue') or item.get('value'):
+                items.append(compact_item(item))
+            card['customFieldItems'] = items
+
+
+class BoardSync(object):
+    '''keeps Board copies of the monitored lists up to date through a
+    TrelloClient, with a full reload every resync seconds'''
+
+    def __init__(self, client, resync=3600, pushed=False):
+        self.client = client
+        self.resync = resync
+        # with webhooks pushing every action, loaded boards are not polled
+        # and only the full resync touches trello
+        self.pushed = pushed
+        self.boards = {}
+        # {board id: [actions]} pushed while the board is being loaded, to
+        # be applied to the new copy before it replaces the old one
+        self.loading = {}
+        self._lock = threading.Lock()
+
+    def load(self, boardid, lists):
+        '''full load of the given lists of a board.  True once done, so
+        client.attempt tells it from a failure.'''
+        with self.client.metrics.timer('trellomon_phase_seconds',
+                                       phase='board_load', board=boardid):
+            self._load(boardid, lists)
+        return True
+
+    def _load(self, boardid, lists):
+        with self._lock:
+            self.loading[boardid] = []
+        try:
+            self._publish(self._fetch_board(boardid, lists))
+        finally:
+            with self._lock:
+                self.loading.pop(boardid, None)
+
+    def _fetch_board(self, boardid, lists):
+        # note the newest action first so nothing between the two requests
+        # is missed; replaying an action we already have is harmless
+        latest = self.client.get('boards/' + boardid + '/actions',
+                                 limit=1, fields='id')
+        # a resync of the lists due now keeps the others of the board, or
+        # the next call for them would load the board in full again
+        lists = set(lists)
+        old = self.boards.get(boardid)
+        if old is not None:
+            lists |= old.lists
+        board = Board(boardid, lists)
+        if latest:
+            board.last_action = latest[0]['id']
+        threshold = self.client.board_threshold
+        if threshold and len(lists) >= threshold:
+            bylist = self.client.get_board_cards(boardid, lists)
+        else:
+            bylist = dict((listid, self.client.get_list_cards(listid))
+                          for listid in lists)
+        for listcards in bylist.values():
+            for card in listcards:
+                board.cards[card['id']] = card
+        return board
+
+    def _publish(self, board):
+        '''apply the actions pushed while board was loading, then make it
+        the copy of its board'''
+        while True:
+            with self._lock:
+                pending = self.loading[board.id]
+                if not pending:
+                    self.boards[board.id] = board
+                    return
+                self.loading[board.id] = []
+            for action in pending:
+                board.apply(action, self.client.get_card)
+
+    def poll(self, boardid):
+        '''apply the actions of a board since the last poll.  True once
+        done.'''
+        with self.client.metrics.timer('trellomon_phase_seconds',
+                                       phase='board_poll', board=boardid):
+            self._poll(boardid)
+        return True
+
+    def _poll(self, boardid):
+        board = self.boards[boardid]
+        params = {'filter': ACTION_FILTER, 'limit': ACTION_LIMIT,
+                  'fields': 'id,type,data,date'}
+        if board.last_action is not None:
+            params['since'] = board.last_action
+        actions = self.client.get('boards/' + boardid + '/actions', **params)
+        if len(actions) >= ACTION_LIMIT:
+            self.load(boardid, board.lists)
+            return
+        # trello lists the newest action first
+        for action in reversed(actions):
+            board.apply(action, self.client.get_card)
+
+    def push(self, action):
+        '''apply an action delivered by a trello webhook.  Returns False
+        when the action's board is not being synced.'''
+        boardid = action.get('data', {}).get('board', {}).get('id')
+        with self._lock:
+            if boardid in self.loading:
+                self.loading[boardid].append(action)
+                return True
+            board = self.boards.get(boardid)
+        if board is None:
+            return False
+        board.apply(action, self.client.get_card)
+        return True
+
+    def reload(self, boardid):
+        '''have the next fetch load a board in full again'''
+        board = self.boards.get(boardid)
+        if board is not None:
+            board.loaded = 0
+
+    def fetch_lists(self, listids):
+        '''return {listid: (cards, custom_field_details)} like
+        TrelloClient.fetch_lists.  When trello cannot be reached, a board
+        keeps the cards of its last good load or poll, and its lists are
+        noted in stale; lists of boards never loaded are left out.'''
+        listids = [listid for (i, listid) in enumerate(listids)
+                   if listid and listid not in listids[:i]]
+        client = self.client
+        listboards = client.map(
+            lambda listid: client.attempt(client.get_list_board, listid),
+            listids)
+        byboard = {}
+        for (listid, boardid) in zip(listids, listboards):
+            if boardid is not None:
+                byboard.setdefault(boardid, []).append(listid)
+        now = time.time()
+        full = []
+        poll = []
+        for (boardid, lists) in byboard.items():
+            board = self.boards.get(boardid)
+            if board is None or not board.lists.issuperset(lists) or \
+                    board.loaded + self.resync <= now:
+                full.append(boardid)
+            elif not self.pushed:
+                poll.append(boardid)
+        synced = client.map(lambda boardid: client.attempt(
+            self.load, boardid, byboard[boardid]), full)
+        synced += client.map(lambda boardid: client.attempt(
+            self.poll, boardid), poll)
+        failed = set(boardid for (boardid, done) in zip(full + poll, synced)
+                     if not done)
+        boardids = list(byboard)
+        custom = dict(zip(boardids, client.map(
+            lambda boardid: client.attempt(client.get_board_custom_fields,
+                                           boardid), boardids)))
+        result = Snapshot()
+        for (listid, boardid) in zip(listids, listboards):
+            board = self.boards.get(boardid)
+            if board is None or listid not in board.lists:
+                continue
+            cards = board.list_cards(listid)
+            if cards and custom[boardid] is None:
+                continue
+            result[listid] = (cards, custom[boardid] if cards else [])
+            if boardid in failed:
+                result.stale.append(listid)
+        return result
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,121 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Expiring cache for trello data that rarely changes: list to board ids, board
+shortLinks and custom field definitions.  The cache can be saved to and
+loaded from a json file so a restart does not have to fetch it all again.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class TTLCache(object):
+    '''dict whose entries expire ttl seconds after they were stored'''
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.data = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = (time.time() + self.ttl, value)
+            self.dirty = True
+
+    def fetch(self, key, func):
+        '''return the cached value for key, calling func() to fill it in
+        when it is missing or expired'''
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self.data.pop(key, None) is not None:
+                    self.dirty = True
+
+    def clear(self):
+        with self._lock:
+            self.data = {}
+            self.dirty = True
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.data)}
+
+    def load(self, filename):
+        '''read unexpired entries from filename, if it exists'''
+        try:
+            with open(filename) as fd:
+                data = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for (key, (expires, value)) in data.items():
+                if expires > now:
+                    self.data[key] = (expires, value)
+
+    def save(self, filename):
+        '''write the cache to filename if it changed since the last save'''
+        with self._lock:
+            if not self.dirty:
+                return
+            data = dict(self.data)
+            self.dirty = False
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(data, fd)
+        os.rename(tmp, filename)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
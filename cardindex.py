@@ -0,0 +1,93 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Index over the cards of a list as last fetched, so they can be searched by
+label, custom field value and name without going back to trello.
+"""
+
+import re
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class CardIndex(object):
+    '''postings from upper-cased label names, custom field values and
+    lower-cased name tokens to the positions of the cards of a CardSet'''
+
+    def __init__(self, cardset):
+        self.cardset = cardset
+        self.rows = list(cardset)
+        self.labels = {}
+        # {custom field id: {text: positions}}
+        self.values = {}
+        self.tokens = {}
+        for (i, (card, values, labels)) in enumerate(self.rows):
+            for name in labels:
+                self.labels.setdefault(name, set()).add(i)
+            for (fieldid, text) in values.items():
+                self.values.setdefault(fieldid, {}).setdefault(
+                    text, set()).add(i)
+            for token in TOKEN_RE.findall(card['name'].lower()):
+                self.tokens.setdefault(token, set()).add(i)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, labels=None, custom_filter=None, words=()):
+        '''the (card, values, labels) rows, in list order, matching the
+        LabelMatcher labels, the CustomFilter custom_filter and every word,
+        which has to be part of a word of the card name.  Labels and custom
+        fields follow the report filters: any pattern or criterion may
+        match.'''
+        found = set(range(len(self.rows)))
+        if labels:
+            found &= self._union(posts for (name, posts)
+                                 in self.labels.items() if labels.match(name))
+        if custom_filter is not None and custom_filter.text:
+            plan = custom_filter.plan(self.cardset.fields)
+            found &= self._union(self.values.get(fieldid, {}).get(text, ())
+                                 for (fieldid, wanted) in plan.items()
+                                 for text in wanted)
+        for word in words:
+            word = word.lower()
+            found &= self._union(posts for (token, posts)
+                                 in self.tokens.items() if word in token)
+        return [self.rows[i] for i in sorted(found)]
+
+    @staticmethod
+    def _union(postings):
+        result = set()
+        for posts in postings:
+            result.update(posts)
+        return result
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -61,6 +61,101 @@ conf.registerGlobalValue(TrelloMon, 'trelloApi',
     registry.String('', """The API key used to connect to Trello""",
     private=True))
 
+conf.registerGlobalValue(TrelloMon, 'trelloUrl',
+    registry.String('https://api.trello.com/1/', """Base URL of the Trello
+    REST API"""))
+
+conf.registerGlobalValue(TrelloMon, 'concurrency',
+    registry.PositiveInteger(4, """How many trello requests may be in flight
+    at once when fetching lists"""))
+
+conf.registerGlobalValue(TrelloMon, 'retries',
+    registry.NonNegativeInteger(3, """How many times a trello request is
+    retried, with a growing random wait, after a 429 or 5xx answer or a
+    connection error.  A list that still cannot be fetched is reported from
+    its last good copy."""))
+
+conf.registerGlobalValue(TrelloMon, 'boardfetch',
+    registry.NonNegativeInteger(2, """When at least this many monitored
+    lists are on the same board, fetch all the open cards of the board in one
+    request instead of one request per list.  0 turns this off."""))
+
+conf.registerGlobalValue(TrelloMon, 'resolveTimeout',
+    registry.PositiveInteger(10, """When the plugin loads, board links
+    missing from the cache are looked up in the background.  How long, in
+    seconds, each of those requests may take before it is given up."""))
+
+conf.registerGlobalValue(TrelloMon, 'cacheTTL',
+    registry.PositiveInteger(3600, """How long, in seconds, board ids, board
+    links and custom field definitions are cached"""))
+
+conf.registerGlobalValue(TrelloMon, 'incremental',
+    registry.Boolean(False, """Keep a copy of the monitored lists and only
+    read the board actions since the last check, instead of downloading every
+    card each time"""))
+
+conf.registerGlobalValue(TrelloMon, 'resyncinterval',
+    registry.PositiveInteger(3600, """In incremental mode, how often, in
+    seconds, every board is downloaded in full to correct any drift"""))
+
+conf.registerGlobalValue(TrelloMon, 'webhook',
+    registry.Boolean(False, """Receive trello webhooks on the bot's HTTP
+    server (under /trellomon/) and apply card changes as they happen.  Boards
+    are then only downloaded every resyncinterval as a safety net.  Takes
+    effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(TrelloMon, 'webhookUrl',
+    registry.String('', """Public URL trello posts webhooks to, for example
+    https://bot.example.com/trellomon/"""))
+
+conf.registerGlobalValue(TrelloMon, 'webhookSecret',
+    registry.String('', """The trello application secret used to verify
+    webhook signatures.  Webhooks are refused until it is set.""",
+    private=True))
+
+conf.registerGlobalValue(TrelloMon, 'coalesce',
+    registry.Boolean(True, """Pack several card lines into one IRC message,
+    separated by ' | ', as long as it fits in an IRC line"""))
+
+conf.registerGlobalValue(TrelloMon, 'sendrate',
+    registry.PositiveFloat(0.5, """How many messages per second may be sent
+    to one channel once the burst is used up"""))
+
+conf.registerGlobalValue(TrelloMon, 'sendburst',
+    registry.PositiveInteger(5, """How many messages may be sent to one
+    channel at once"""))
+
+conf.registerGlobalValue(TrelloMon, 'sendbacklog',
+    registry.PositiveInteger(30, """How many messages may wait for one
+    channel.  Past that the rest of the report is dropped and replaced by a
+    count of what was dropped."""))
+
+conf.registerGlobalValue(TrelloMon, 'metricsFile',
+    registry.String('', """If set, the metrics are written to this file
+    (relative to the data directory) in the Prometheus text format after
+    every check"""))
+
+conf.registerGlobalValue(TrelloMon, 'metricsHttp',
+    registry.Boolean(False, """Serve the metrics in the Prometheus text
+    format on the bot's HTTP server, under /trellomon-metrics/.  Takes effect
+    when the plugin is reloaded."""))
+
+conf.registerGlobalValue(TrelloMon, 'shardFile',
+    registry.String('', """If set, the SQLite file (relative to the data
+    directory) through which several bots split the monitored lists between
+    them.  Each list is then fetched by one bot only, which publishes the
+    cards for the others to report.  Takes effect when the plugin is
+    reloaded."""))
+
+conf.registerGlobalValue(TrelloMon, 'shardName',
+    registry.String('', """The name of this bot in the shard file.  Defaults
+    to the host name and process id."""))
+
+conf.registerGlobalValue(TrelloMon, 'shardLease',
+    registry.PositiveInteger(120, """How long, in seconds, a list stays with
+    the bot fetching it after that bot last renewed its claim.  A list whose
+    bot stops renewing moves to another bot after this long."""))
+
 conf.registerGlobalValue(TrelloMon, 'lists',
 registry.SpaceSeparatedListOfStrings([], """Lists that are being
     monitored"""))
@@ -69,10 +164,16 @@ conf.registerGlobalValue(TrelloMon, 'debug', registry.Boolean(False,
 """print debug logs to console"""))
 
 conf.registerGlobalValue(TrelloMon, 'queryinterval',
-                         registry.PositiveInteger(600, """Cadence for querying
-                         the board for updates in seconds.  Individual lists
-                         will report on channel with the <list>.interval
-                         configuration."""))
+                         registry.PositiveInteger(600, """How often, in seconds,
+                         the list jobs are replanned to pick up configuration
+                         changes.  Each list is otherwise checked when its
+                         <list>.interval falls due on a channel."""))
+
+conf.registerGlobalValue(TrelloMon, 'stagger',
+                         registry.NonNegativeInteger(60, """Lists that
+                         fall due together are checked one after the other
+                         over this many seconds, with some random jitter,
+                         rather than all at once"""))
 
 conf.registerChannelValue(TrelloMon, 'showlabels', registry.Boolean(False,
                           """Show labels/versions in the output"""))
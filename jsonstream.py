@@ -0,0 +1,114 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Incremental decoding of a json array, one element at a time, so a large
+trello response never has to be held as text and as a whole tree of dicts.
+"""
+
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+class _Buffer(object):
+    '''the text of the chunks not consumed yet'''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        '''append the next chunk, dropping what has been consumed.  False
+        when there are no more chunks.'''
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.utf8.decode(b'', True)
+        else:
+            text = self.utf8.decode(chunk)
+        self.text = self.text[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''the next character that is not whitespace, or None at the end'''
+        while True:
+            while self.pos < len(self.text) and \
+                    self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return None
+
+
+def iter_array(chunks, decoder=None):
+    '''yield the elements of the json array whose utf-8 text comes in
+    chunks of bytes.  Raises ValueError when the text is not an array or is
+    cut short.'''
+    decoder = decoder or json.JSONDecoder()
+    buf = _Buffer(chunks)
+    if buf.peek() != '[':
+        raise ValueError('expected a json array')
+    buf.pos += 1
+    if buf.peek() == ']':
+        return
+    while True:
+        if buf.peek() is None:
+            raise ValueError('json array cut short')
+        try:
+            (value, end) = decoder.raw_decode(buf.text, buf.pos)
+        except ValueError:
+            end = None
+        # an element that fails, or runs to the end of the text, may go on
+        # in the next chunk
+        if end is None or end == len(buf.text):
+            if buf.more():
+                continue
+            if end is None:
+                raise ValueError('json array cut short')
+        yield value
+        buf.pos = end
+        separator = buf.peek()
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('expected , or ] in json array')
+        buf.pos += 1
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
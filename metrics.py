@@ -0,0 +1,133 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+In-process metrics: counters and timing summaries keyed by name and labels,
+cheap enough to leave on, and exported in the Prometheus text format.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _labels(labels):
+    '''{"a": 1} -> "{a=\"1\"}"'''
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\') \
+        .replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (name, escape(value))
+                          for (name, value) in labels) + '}'
+
+
+class Metrics(object):
+    '''thread safe counters and timings.  Labels are keyword arguments.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels): value
+        self.counters = {}
+        # (name, labels): [count, total seconds, max seconds]
+        self.timings = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''time the with block'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def counter_values(self, name):
+        '''{labels: value} of one counter'''
+        with self._lock:
+            return dict((labels, value) for ((each, labels), value)
+                        in self.counters.items() if each == name)
+
+    def timing_values(self, name):
+        '''{labels: (count, total, max)} of one timing'''
+        with self._lock:
+            return dict((labels, tuple(timing)) for ((each, labels), timing)
+                        in self.timings.items() if each == name)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+    def prometheus(self, gauges=()):
+        '''the metrics in the Prometheus text format.  gauges are extra
+        (name, {labels}, value) samples read at export time.'''
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted((key, tuple(timing))
+                             for (key, timing) in self.timings.items())
+        lines = []
+        typed = set()
+
+        def sample(name, kind, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, _labels(labels), repr(value)))
+        for ((name, labels), value) in counters:
+            sample(name, 'counter', labels, value)
+        for ((name, labels), (count, total, top)) in timings:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s summary' % name)
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), total))
+        for ((name, labels), (count, total, top)) in timings:
+            sample(name + '_max', 'gauge', labels, top)
+        for (name, labels, value) in sorted(gauges, key=lambda g: g[0]):
+            sample(name, 'gauge', tuple(sorted(labels.items())), value)
+        return '\n'.join(lines) + '\n'
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
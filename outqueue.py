@@ -0,0 +1,175 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Outgoing message stage.  Card lines for a channel are packed into as few
+PRIVMSGs as fit in an IRC line, queued per network and channel, and released
+through a token bucket so a big report does not trip the network's flood
+limits.  When a channel's backlog grows past a limit, the tail is replaced by
+a short summary.
+"""
+
+import threading
+import time
+from collections import deque
+
+# RFC 1459 line limit, CRLF included
+LINE_LIMIT = 512
+
+# Room left for ":nick!user@host " when the bot's own prefix is unknown
+PREFIX_ALLOWANCE = 100
+
+SEPARATOR = ' | '
+
+
+def budget(irc, channel):
+    '''how many bytes of text fit in one PRIVMSG to channel, once the
+    server has prepended our prefix'''
+    prefix = getattr(irc, 'prefix', None)
+    overhead = len(' PRIVMSG %s :\r\n' % channel)
+    if prefix:
+        overhead += len(prefix) + 2
+    else:
+        overhead += PREFIX_ALLOWANCE
+    return LINE_LIMIT - overhead
+
+
+def pack(lines, size, separator=SEPARATOR):
+    '''join consecutive lines into messages of at most size bytes.  A line
+    that is too long on its own is left alone.'''
+    messages = []
+    current = None
+    used = 0
+    extra = len(separator.encode('utf-8'))
+    for line in lines:
+        length = len(line.encode('utf-8'))
+        if current is not None and used + extra + length <= size:
+            current.append(line)
+            used += extra + length
+        else:
+            if current is not None:
+                messages.append(separator.join(current))
+            current = [line]
+            used = length
+    if current is not None:
+        messages.append(separator.join(current))
+    return messages
+
+
+class TokenBucket(object):
+    '''allows burst messages at once, refilling at rate per second'''
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time() if now is None else now
+
+    def take(self, now):
+        '''use a token if there is one and return 0, otherwise return how
+        many seconds until there will be'''
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class OutQueue(object):
+    '''per (network, channel) queues of outgoing messages.  send(irc,
+    channel, text) is called for every message released.'''
+
+    def __init__(self, send, rate=0.5, burst=5, backlog=30, coalesce=True):
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.backlog = backlog
+        self.coalesce = coalesce
+        self.queues = {}
+        self.buckets = {}
+        self.sent = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, irc, channel, lines):
+        '''queue lines for channel, packed together when coalescing'''
+        if self.coalesce:
+            lines = pack(lines, budget(irc, channel))
+        key = (irc.network, channel)
+        with self._lock:
+            (target, queue) = self.queues.setdefault(key, (irc, deque()))
+            queue.extend(lines)
+            if len(queue) > self.backlog:
+                keep = max(self.backlog - 1, 0)
+                dropped = len(queue) - keep
+                for i in range(dropped):
+                    queue.pop()
+                queue.append("... %d more messages dropped" % dropped)
+                self.dropped += dropped
+
+    def flush(self, now=None):
+        '''send whatever the buckets allow.  Returns the seconds until the
+        next queued message may go, or None when everything was sent.'''
+        if now is None:
+            now = time.time()
+        wait = None
+        released = []
+        with self._lock:
+            for (key, (irc, queue)) in list(self.queues.items()):
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(self.rate,
+                                                             self.burst, now)
+                while queue:
+                    left = bucket.take(now)
+                    if left:
+                        if wait is None or left < wait:
+                            wait = left
+                        break
+                    released.append((irc, key[1], queue.popleft()))
+                if not queue:
+                    del self.queues[key]
+            self.sent += len(released)
+        for (irc, channel, text) in released:
+            self.send(irc, channel, text)
+        return wait
+
+    def stats(self):
+        '''{(network, channel): queued messages} plus sent/drop counts'''
+        with self._lock:
+            depth = dict((key, len(queue))
+                         for (key, (irc, queue)) in self.queues.items())
+        return {'depth': depth, 'sent': self.sent, 'dropped': self.dropped}
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -36,14 +36,34 @@ import supybot.ircutils as ircutils
 import supybot.ircmsgs as ircmsgs
 import supybot.callbacks as callbacks
 import supybot.conf as conf
+import supybot.ircdb as ircdb
 import supybot.schedule as schedule
 import supybot.registry as registry
+import supybot.httpserver as httpserver
 import requests
 from ast import literal_eval
 from trello import TrelloApi
-import sys
+from .boardsync import BoardSync
+from .cache import TTLCache
+from .cardindex import CardIndex
+from .metrics import Metrics
+from .outqueue import OutQueue
+from .statestore import ChannelState, StateStore
+from .shards import ShardStore
+from .render import CardSet, CustomFilter, FieldIndex, LabelMatcher, Template
+from .trelloclient import Snapshot, TrelloClient
+import base64
+from collections import namedtuple
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
 import time
-import re
+import socket
+import sqlite3
+import zlib
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('TrelloMon')
@@ -53,6 +73,90 @@ except ImportError:
     _ = lambda x: x
 
 
+# The settings of a list for one channel, see TrelloMon.channel_config
+ChannelConfig = namedtuple('ChannelConfig', [
+    'active', 'interval', 'labels', 'custom_filter', 'precustom',
+    'postcustom', 'showlabels', 'verbose', 'message', 'url', 'diff',
+    'digest'])
+
+INACTIVE = ChannelConfig(False, None, None, None, None, None, False, False,
+                         "", "", False, 0)
+
+# After a check in which trello failed us, a job waits this many seconds,
+# doubled for every further failure and at most queryinterval, before its
+# lists are tried again
+RETRY_BACKOFF = 60
+
+
+class ListJob(object):
+    '''the timed job checking the monitored lists of one trello board (or
+    one list, until its board is known)'''
+    __slots__ = ('key', 'next_run', 'last_start', 'last_duration',
+                 'running', 'failures', 'retry_at')
+
+    def __init__(self, key):
+        self.key = key
+        self.next_run = None
+        self.last_start = None
+        self.last_duration = None
+        self.running = False
+        # checks in a row that left a due list unfetched, and the time
+        # before which the job is not run again
+        self.failures = 0
+        self.retry_at = None
+
+
+class TrelloWebhook(httpserver.SupyHTTPServerCallback):
+    """Receives trello webhook callbacks and applies their actions to the
+    monitored boards right away"""
+    name = 'TrelloMon'
+    public = False
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def doHead(self, handler, path):
+        # trello checks that the callback URL answers before creating the
+        # webhook
+        handler.send_response(200)
+        self.end_headers()
+
+    def doPost(self, handler, path, form=None):
+        signature = self.headers.get('X-Trello-Webhook', '')
+        if not isinstance(form, bytes) or \
+                not self.plugin.verify_webhook(form, signature):
+            handler.send_response(401)
+            self.end_headers()
+            return
+        try:
+            action = json.loads(form.decode('utf-8'))['action']
+        except (ValueError, KeyError, TypeError):
+            handler.send_response(400)
+            self.end_headers()
+            return
+        self.plugin.push_action(action)
+        handler.send_response(200)
+        self.end_headers()
+
+
+class TrelloMetrics(httpserver.SupyHTTPServerCallback):
+    """Serves the plugin's metrics in the Prometheus text format"""
+    name = 'TrelloMon metrics'
+    public = False
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def doGetOrHead(self, handler, path, write_content):
+        response = self.plugin.prometheus().encode('utf-8')
+        handler.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        if write_content:
+            self.wfile.write(response)
+
+
 class TrelloMon(callbacks.Plugin):
     """Trello List Monitor bot"""
     threaded = True
@@ -61,38 +165,420 @@ class TrelloMon(callbacks.Plugin):
         self.__parent = super(TrelloMon, self)
         self.__parent.__init__(irc)
         self.trello = None
+        self.client = None
+        self.sync = None
+        self.cache = TTLCache(self.registryValue('cacheTTL'))
+        self.cache.load(self.cache_file())
+        self.metrics = Metrics()
         self.reload_trello()
-        self.last_run = {}
-        for name in self.registryValue('lists'):
-            self.register_list(name)
+        # {(network, entry, channel): ChannelState}, and the keys changed
+        # since the last save
+        self.states = {}
+        self.dirty = set()
+        self.store = StateStore(self.state_file())
+        self.load_state()
+        self.shards = self.shard_store()
+        self.next_check = None
+        self.jobs = {}
+        # job threads reschedule events too: the lock keeps the removal and
+        # the new event of a name together, and once the agent is stopped
+        # (or the plugin dead) nothing is scheduled again
+        self.events_lock = threading.Lock()
+        self.stopped = True
+        self.dead = False
+        # {list id: CardIndex} of the cards last fetched
+        self.index = {}
+        self.templates = {}
+        self.filters = {}
+        self.matchers = {}
+        self.configs = {}
+        self.outbox = OutQueue(self._deliver)
+        self.configure_outbox()
+        # no trello request here: board links come from the cache, and the
+        # missing ones are looked up in the background
+        self.resolver = None
+        self.resolve_in_background([name for name
+                                    in self.registryValue('lists')
+                                    if not self.register_list(name)])
+        self.webhook = None
+        if self.registryValue('webhook'):
+            self.webhook = TrelloWebhook(self)
+            httpserver.hook('trellomon', self.webhook)
+        self.metrics_page = None
+        if self.registryValue('metricsHttp'):
+            self.metrics_page = TrelloMetrics(self)
+            httpserver.hook('trellomon-metrics', self.metrics_page)
         try:
-            schedule.addPeriodicEvent(self.check_trello,
-                                      self.registryValue('queryinterval'),
-                                      name=self.name(), now=False)
+            self.start_agent()
         except:
             pass
-        reload(sys)
 
-    def debug(self, msg):
-        self.log.debug(str(msg))
+    def debug(self, msg, *args):
+        '''log at debug level.  Pass the values to format as args so no
+        string work is done when debug logging is off.'''
+        self.log.debug(str(msg), *args)
 
     def die(self):
         self.debug(self.name())
         self.__parent.die()
-        schedule.removeEvent(self.name())
+        if self.webhook is not None:
+            httpserver.unhook('trellomon')
+            self.webhook = None
+        if self.metrics_page is not None:
+            httpserver.unhook('trellomon-metrics')
+            self.metrics_page = None
+        self.client.close()
+        self.save_cache()
+        with self.events_lock:
+            self.dead = True
+            try:
+                schedule.removeEvent(self.name() + '.send')
+            except KeyError:
+                pass
+        self.stop_agent()
+
+    def stop_agent(self):
+        '''unschedule the list jobs and the replanning; the plugin stays
+        loaded and its web endpoints hooked.  A job running meanwhile
+        finishes its check but is not rescheduled.'''
+        with self.events_lock:
+            self.stopped = True
+        for key in list(self.jobs):
+            self.remove_job(key)
+        if self.shards is not None:
+            try:
+                schedule.removeEvent(self.name() + '.shards')
+            except KeyError:
+                pass
+            # hand our lists over now rather than when the leases expire
+            try:
+                self.shards.release()
+            except sqlite3.Error as e:
+                self.log.warning("could not release the shard leases: %s"
+                                 % e)
+        try:
+            schedule.removeEvent(self.name())
+        except KeyError:
+            pass
+        self.next_check = None
+
+    def start_agent(self):
+        '''schedule the list jobs, and replan them every queryinterval so
+        configuration changes are picked up'''
+        with self.events_lock:
+            self.stopped = False
+        try:
+            schedule.removeEvent(self.name())
+        except KeyError:
+            pass
+        schedule.addPeriodicEvent(self.schedule_jobs,
+                                  self.registryValue('queryinterval'),
+                                  name=self.name(), now=False)
+        if self.shards is not None:
+            try:
+                schedule.removeEvent(self.name() + '.shards')
+            except KeyError:
+                pass
+            schedule.addPeriodicEvent(self.renew_shards,
+                                      max(self.shards.lease / 3.0, 1),
+                                      name=self.name() + '.shards')
+        self.schedule_jobs()
+
+    def job_event(self, key):
+        return '%s.job.%s' % (self.name(), key)
+
+    def remove_job(self, key):
+        try:
+            schedule.removeEvent(self.job_event(key))
+        except KeyError:
+            pass
+        self.jobs.pop(key, None)
+
+    def job_entries(self, entries):
+        '''{job key: [entries]}.  Lists of the same board share a job, so
+        the board can be fetched in one go; a list whose board is not known
+        yet has a job of its own.'''
+        byjob = {}
+        for entry in entries:
+            listid = self.registryValue('lists.' + entry + '.list_id')
+            if listid:
+                key = self.client.list_boards.get(listid, listid)
+                byjob.setdefault(key, []).append(entry)
+        return byjob
+
+    def schedule_jobs(self, keys=None):
+        '''give every monitored board (or just the jobs of keys) its own
+        timed job, due when one of its lists next falls due on a channel.
+        Jobs due together are spread over stagger seconds, and every run
+        gets a little jitter, so fetches do not all land on the same tick.
+        A job already due sooner is left alone.'''
+        if keys is None:
+            self.configs = {}
+        entries = self.registryValue('lists')
+        byjob = self.job_entries(entries)
+        (due, waits) = self.plan_cycle(entries, time.mktime(time.gmtime()))
+        for key in [key for key in self.jobs
+                    if key not in byjob and not self.jobs[key].running]:
+            self.remove_job(key)
+        order = sorted(byjob)
+        slot = float(self.registryValue('stagger')) / max(len(order), 1)
+        now = time.time()
+        for key in keys or order:
+            job = self.jobs.get(key)
+            if job is not None and job.running:
+                continue
+            lefts = [waits[entry] for entry in byjob.get(key, ())
+                     if entry in waits]
+            if not lefts:
+                # no active channel
+                self.remove_job(key)
+                continue
+            wait = max(min(lefts), 0)
+            if wait == 0:
+                # due now, take its turn in the stagger window
+                wait = slot * order.index(key)
+            wait += random.uniform(0, slot)
+            if job is None:
+                job = self.jobs[key] = ListJob(key)
+            if job.retry_at is not None:
+                # its lists are still due because trello failed us
+                wait = max(wait, job.retry_at - now)
+            if job.next_run is not None and \
+                    max(now, job.retry_at or 0) < job.next_run <= now + wait:
+                continue
+            with self.events_lock:
+                if self.stopped:
+                    break
+                try:
+                    schedule.removeEvent(self.job_event(key))
+                except KeyError:
+                    pass
+                job.next_run = now + wait
+                schedule.addEvent(lambda key=key: self.run_job(key),
+                                  job.next_run, name=self.job_event(key))
+        runs = [job.next_run for job in self.jobs.values()
+                if job.next_run is not None]
+        self.next_check = min(runs) if runs else \
+            now + self.registryValue('queryinterval')
+
+    def run_job(self, key):
+        '''scheduled: check the lists of a job on a thread of its own, so a
+        slow board does not hold up the others or the bot'''
+        job = self.jobs.get(key)
+        if job is None or job.running:
+            return
+        job.running = True
+        job.next_run = None
+        thread = threading.Thread(target=self.check_job, args=(job,),
+                                  name='%s %s' % (self.name(), key))
+        thread.daemon = True
+        thread.start()
+
+    def check_job(self, job):
+        job.last_start = time.time()
+        entries = []
+        failed = True
+        try:
+            entries = self.job_entries(
+                self.registryValue('lists')).get(job.key, [])
+            for key in [key for key in list(self.configs)
+                        if key[0] in entries]:
+                self.configs.pop(key, None)
+            self.configure_outbox()
+            failed = bool(self.check_lists(entries))
+        except Exception:
+            self.log.exception("checking trello job %s failed", job.key)
+        finally:
+            self.back_off(job, failed)
+            job.last_duration = time.time() - job.last_start
+            self.metrics.observe('trellomon_job_seconds', job.last_duration,
+                                 job=job.key)
+            job.running = False
+            if not self.stopped:
+                # a list job becomes a board job once its board is known
+                self.schedule_jobs([job.key] +
+                                   list(self.job_entries(entries)))
+
+    def back_off(self, job, failed):
+        '''after a check that left some due list unfetched, hold the job
+        off for RETRY_BACKOFF seconds, doubled for every failure in a row
+        and at most queryinterval.  A good check clears it.'''
+        if not failed:
+            job.failures = 0
+            job.retry_at = None
+            return
+        job.failures += 1
+        job.retry_at = time.time() + min(
+            self.registryValue('queryinterval'),
+            RETRY_BACKOFF * 2 ** (job.failures - 1))
+
+    def verify_webhook(self, body, signature):
+        '''check the X-Trello-Webhook signature of a webhook request body'''
+        secret = self.registryValue('webhookSecret')
+        if not secret:
+            self.log.warning("refusing trello webhook: webhookSecret is not set")
+            return False
+        content = body + self.registryValue('webhookUrl').encode('utf-8')
+        digest = hmac.new(secret.encode('utf-8'), content, hashlib.sha1)
+        expected = base64.b64encode(digest.digest()).decode('ascii')
+        return hmac.compare_digest(expected, signature)
+
+    def push_action(self, action):
+        '''apply an action delivered by a webhook to the synced boards'''
+        self.debug("webhook action:  %s", action.get('type'))
+        try:
+            if not self.sync.push(action):
+                self.debug("webhook action for a board that is not loaded")
+        except requests.RequestException as e:
+            # trello still gets its 200; the board catches up on a full load
+            boardid = action.get('data', {}).get('board', {}).get('id')
+            self.log.warning("could not apply a webhook action to board %s, "
+                             "reloading it: %s" % (boardid, e))
+            self.sync.reload(boardid)
+
+    def shard_store(self):
+        '''the ShardStore of shardFile, or None when sharding is off'''
+        filename = self.registryValue('shardFile')
+        if not filename:
+            return None
+        member = self.registryValue('shardName') or \
+            '%s:%d' % (socket.gethostname(), os.getpid())
+        return ShardStore(conf.supybot.directories.data.dirize(filename),
+                          member, self.registryValue('shardLease'))
+
+    def renew_shards(self):
+        '''scheduled: renew the claims on every list active on one of our
+        channels, so their leases stay with us between checks'''
+        entries = self.registryValue('lists')
+        (due, waits) = self.plan_cycle(entries, time.mktime(time.gmtime()))
+        listids = [self.registryValue('lists.' + entry + '.list_id')
+                   for entry in waits]
+        try:
+            self.shards.claim([listid for listid in listids if listid])
+        except sqlite3.Error as e:
+            self.log.warning("could not renew the shard leases: %s" % e)
+
+    def shard_lists(self, listids, max_age):
+        '''split listids into the ones this bot fetches, and
+        {list_id: (cards, custom field details)} published by the other
+        bots for the rest.  A list of another bot that has not been
+        published in the last max_age[list_id] seconds is fetched here
+        too.'''
+        try:
+            owned = self.shards.claim(listids)
+            published = self.shards.read([listid for listid in listids
+                                          if listid not in owned], max_age)
+        except sqlite3.Error as e:
+            self.log.warning("could not read the shard file, fetching "
+                             "every list: %s" % e)
+            return (listids, {})
+        late = [listid for listid in listids
+                if listid not in owned and listid not in published]
+        if late:
+            self.debug("lists not published lately by their shard: %s",
+                       ", ".join(late))
+        return ([listid for listid in listids if listid not in published],
+                published)
+
+    def publish_lists(self, snapshot):
+        '''make the lists fetched this cycle available to the other bots'''
+        fresh = dict((listid, lists) for (listid, lists) in snapshot.items()
+                     if listid not in snapshot.stale)
+        try:
+            self.shards.publish(fresh)
+        except sqlite3.Error as e:
+            self.log.warning("could not publish to the shard file: %s" % e)
+
+    def cache_file(self):
+        return conf.supybot.directories.data.dirize(self.name() + '.cache.json')
+
+    def state_file(self):
+        return conf.supybot.directories.data.dirize(self.name() + '.state.db')
+
+    def load_state(self):
+        try:
+            self.states = self.store.load()
+        except sqlite3.Error as e:
+            self.log.warning("could not load the monitoring state: %s" % e)
+
+    def save_state(self):
+        '''write the channel states changed this cycle in one go'''
+        # list jobs run side by side, so take the set rather than clear it
+        (dirty, self.dirty) = (self.dirty, set())
+        if not dirty:
+            return
+        try:
+            self.store.save(dict((key, self.states[key]) for key in dirty))
+        except sqlite3.Error as e:
+            self.dirty.update(dirty)
+            self.log.warning("could not save the monitoring state: %s" % e)
+
+    def save_cache(self):
+        try:
+            self.cache.save(self.cache_file())
+        except (IOError, OSError) as e:
+            self.log.warning("could not save the trello cache: %s" % e)
 
     def _send(self, message, channel, irc):
+        '''queue message for channel'''
+        self._send_lines([message], channel, irc)
+
+    def _send_lines(self, lines, channel, irc):
+        '''queue lines for channel, packed and paced by the outbox'''
+        if lines:
+            with self.metrics.timer('trellomon_phase_seconds', phase='send',
+                                    network=irc.network, channel=channel):
+                self.outbox.put(irc, channel, lines)
+
+    def _deliver(self, irc, channel, message):
         '''send message to irc'''
         msg = ircmsgs.privmsg(channel, message)
         irc.queueMsg(msg)
+        self.metrics.count('trellomon_messages_total', network=irc.network,
+                           channel=channel)
+
+    def configure_outbox(self):
+        '''apply the send queue settings'''
+        self.outbox.coalesce = self.registryValue('coalesce')
+        self.outbox.rate = self.registryValue('sendrate')
+        self.outbox.burst = self.registryValue('sendburst')
+        self.outbox.backlog = self.registryValue('sendbacklog')
+
+    def flush_outbox(self):
+        '''send what the flood limits allow and come back for the rest'''
+        wait = self.outbox.flush()
+        with self.events_lock:
+            if self.dead:
+                return
+            try:
+                schedule.removeEvent(self.name() + '.send')
+            except KeyError:
+                pass
+            if wait is not None:
+                schedule.addEvent(self.flush_outbox, time.time() + wait,
+                                  name=self.name() + '.send')
 
     def reload_trello(self):
         self.trello = None
         self.trello = TrelloApi(self.registryValue('trelloApi'))
         self.trello.set_token(self.registryValue('trelloToken'))
+        if self.client is not None:
+            self.client.close()
+        self.cache.ttl = self.registryValue('cacheTTL')
+        self.client = TrelloClient(self.registryValue('trelloApi'),
+                                   self.registryValue('trelloToken'),
+                                   self.registryValue('trelloUrl'),
+                                   self.registryValue('concurrency'),
+                                   cache=self.cache,
+                                   retries=self.registryValue('retries'),
+                                   metrics=self.metrics,
+                                   board_threshold=self.registryValue('boardfetch'))
+        self.sync = BoardSync(self.client, self.registryValue('resyncinterval'),
+                              self.registryValue('webhook'))
 
     def reload(self, irc, msg, args):
-        '''reload trello api'''
+        '''reload trello api and forget cached board data'''
+        self.cache.clear()
         self.reload_trello()
         if self.trello is not None:
             irc.replySuccess()
@@ -100,29 +586,207 @@ class TrelloMon(callbacks.Plugin):
             irc.replyFailure()
     reloadtrello = wrap(reload, [])
 
+    def registerwebhooks(self, irc, msg, args):
+        '''register trello webhooks for the boards of the monitored lists'''
+        url = self.registryValue('webhookUrl')
+        if not url:
+            irc.error("webhookUrl is not set")
+            return
+        boards = set()
+        for entry in self.registryValue('lists'):
+            boards.add(self.client.get_list_board(
+                self.registryValue('lists.' + entry + '.list_id')))
+        failed = []
+        for boardid in sorted(boards):
+            try:
+                self.client.create_webhook(boardid, url)
+            except requests.RequestException as e:
+                self.log.warning("webhook for board %s failed: %s" %
+                                 (boardid, e))
+                failed.append(boardid)
+        if failed:
+            irc.error("could not register webhooks for: " + ", ".join(failed))
+        else:
+            irc.reply("registered webhooks for %d boards" % len(boards))
+    registerwebhooks = wrap(registerwebhooks, ['admin'])
+
+    def cachestats(self, irc, msg, args):
+        '''show hit/miss counters of the board data cache'''
+        irc.reply("cache hits: %(hits)d, misses: %(misses)d, "
+                  "entries: %(entries)d" % self.cache.stats())
+    cachestats = wrap(cachestats, ['admin'])
+
+    def trellostats(self, irc, msg, args):
+        '''show trello request, retry and failure counters and the rate
+        limit budget left'''
+        client = self.client
+        budget = ", ".join("%s: %d" % item
+                           for item in sorted(client.budget.items()))
+        irc.reply("requests: %d, retried: %d, failed: %d, budget left: %s" %
+                  (client.requests, client.retried, client.failures,
+                   budget or "unknown"))
+    trellostats = wrap(trellostats, ['admin'])
+
+    def queuestats(self, irc, msg, args):
+        '''show the outgoing message queue depth and drop counters'''
+        stats = self.outbox.stats()
+        depth = ", ".join("%s %s: %d" % (network, chan, count)
+                          for ((network, chan), count)
+                          in sorted(stats['depth'].items()))
+        irc.reply("queued: %d, sent: %d, dropped: %d%s" %
+                  (sum(stats['depth'].values()), stats['sent'],
+                   stats['dropped'], " (" + depth + ")" if depth else ""))
+    queuestats = wrap(queuestats, ['admin'])
+
+    def gauges(self):
+        '''(name, labels, value) samples read when the metrics are exported'''
+        cache = self.cache.stats()
+        outbox = self.outbox.stats()
+        samples = [('trellomon_cache_hits', {}, cache['hits']),
+                   ('trellomon_cache_misses', {}, cache['misses']),
+                   ('trellomon_cache_entries', {}, cache['entries']),
+                   ('trellomon_outbox_sent', {}, outbox['sent']),
+                   ('trellomon_outbox_dropped', {}, outbox['dropped'])]
+        for ((network, channel), depth) in outbox['depth'].items():
+            samples.append(('trellomon_outbox_queued',
+                            {'network': network, 'channel': channel}, depth))
+        for (name, remaining) in self.client.budget.items():
+            samples.append(('trellomon_rate_limit_remaining',
+                            {'budget': name}, remaining))
+        if self.shards is not None:
+            samples.append(('trellomon_shard_lists_owned', {},
+                            len(self.shards.owned)))
+        return samples
+
+    def prometheus(self):
+        return self.metrics.prometheus(self.gauges())
+
+    def write_metrics(self):
+        '''write the metrics to metricsFile, if set'''
+        filename = self.registryValue('metricsFile')
+        if not filename:
+            return
+        filename = conf.supybot.directories.data.dirize(filename)
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                f.write(self.prometheus())
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            self.log.warning("could not write the metrics: %s" % e)
+
+    def cyclestats(self, irc, msg, args, phase):
+        '''[<phase>]
+
+        show where check cycles spend their time: the slowest phases (or
+        the slowest lists/channels of <phase>), trello request latency,
+        cache hit rate and messages sent'''
+        timings = self.metrics.timing_values('trellomon_phase_seconds')
+        if phase is not None:
+            rows = [(total, count, top, ", ".join("%s=%s" % label for label
+                                                  in labels
+                                                  if label[0] != 'phase'))
+                    for (labels, (count, total, top)) in timings.items()
+                    if ('phase', phase) in labels]
+        else:
+            byphase = {}
+            for (labels, (count, total, top)) in timings.items():
+                name = dict(labels)['phase']
+                (c, t, m) = byphase.get(name, (0, 0, 0))
+                byphase[name] = (c + count, t + total, max(m, top))
+            rows = [(total, count, top, name) for (name, (count, total, top))
+                    in byphase.items()]
+        rows.sort(reverse=True)
+        replies = ["%s: %d, %.3fs total, %.3fs max" % (name, count, total, top)
+                   for (total, count, top, name) in rows[:5]]
+        requests = self.metrics.timing_values('trellomon_http_request_seconds')
+        count = sum(timing[0] for timing in requests.values())
+        total = sum(timing[1] for timing in requests.values())
+        errors = sum(value for (labels, value) in self.metrics.counter_values(
+            'trellomon_http_requests_total').items()
+            if dict(labels)['status'] != '200')
+        replies.append("http: %d requests, %.0fms avg, %d errors" %
+                       (count, 1000 * total / count if count else 0, errors))
+        cache = self.cache.stats()
+        lookups = cache['hits'] + cache['misses']
+        replies.append("cache hit rate: %d%%" %
+                       (100 * cache['hits'] / lookups if lookups else 0))
+        replies.append("messages: %d" % sum(self.metrics.counter_values(
+            'trellomon_messages_total').values()))
+        irc.reply("; ".join(replies))
+    cyclestats = wrap(cyclestats, ['admin', optional('something')])
+
     def kill(self, irc, msg, args):
         ''' kill auto-updates'''
-        self.die()
+        self.stop_agent()
     killagent = wrap(kill, ['admin'])
 
     def startagent(self, irc, msg, args):
         '''start the monitoring agent'''
         self.debug(self.name())
-        try:
-            self.die()
-        except:
-            pass
-        schedule.addPeriodicEvent(self.check_trello,
-                                  self.registryValue('queryinterval'),
-                                  name=self.name(), now=True)
+        self.stop_agent()
+        self.start_agent()
     startagent = wrap(startagent, ['admin'])
 
+    def nextcheck(self, irc, msg, args):
+        '''show when the monitoring agent will next check trello'''
+        if self.next_check is None:
+            irc.reply("the monitoring agent is not scheduled")
+        else:
+            irc.reply("next check in %d seconds" %
+                      max(0, self.next_check - time.time()))
+    nextcheck = wrap(nextcheck, [])
+
+    def listjobs(self, irc, msg, args):
+        '''show when each monitored board (or list) is checked next and how
+        long its last check took'''
+        byjob = self.job_entries(self.registryValue('lists'))
+        now = time.time()
+        replies = []
+        for (key, job) in sorted(self.jobs.items()):
+            if job.running:
+                state = "running"
+            elif job.next_run is None:
+                state = "not scheduled"
+            else:
+                state = "next in %ds" % max(0, job.next_run - now)
+            if job.last_duration is not None:
+                state += ", last took %.2fs" % job.last_duration
+            if job.failures:
+                state += ", %d failed" % job.failures
+            replies.append("%s (%s): %s" % (
+                key, ", ".join(byjob.get(key, ())), state))
+        irc.reply("; ".join(replies) or "no list is active")
+    listjobs = wrap(listjobs, ['admin'])
+
+    def shardstats(self, irc, msg, args):
+        '''show which bot fetches each monitored list in shard mode'''
+        if self.shards is None:
+            irc.reply("sharding is off, see shardFile")
+            return
+        try:
+            owners = self.shards.owners()
+            members = self.shards.members()
+        except sqlite3.Error as e:
+            irc.error("could not read the shard file: %s" % e)
+            return
+        replies = []
+        for member in members:
+            lists = sorted(key for (key, owner) in owners.items()
+                           if owner == member)
+            replies.append("%s%s: %s" % (
+                member, " (me)" if member == self.shards.member else "",
+                ", ".join(lists) or "nothing"))
+        irc.reply("; ".join(replies) or "no bot has claimed a list yet")
+    shardstats = wrap(shardstats, ['admin'])
+
     def apikey(self, irc, msg, args):
         '''print apikey'''
         irc.reply(self.registryValue('trelloApi'))
     apikey = wrap(apikey, [])
 
     def register_list(self, name, trelloid=""):
+        '''register the settings of a list.  Returns whether the link to its
+        board was known.'''
         install = conf.registerGroup(conf.supybot.plugins.TrelloMon.lists,
                                      name.lower())
 
@@ -161,41 +825,84 @@ class TrelloMon(callbacks.Plugin):
 
         conf.registerChannelValue(install, "labels", registry.String("",
                                   """comma separated list of labels to show"""))
+
+        conf.registerChannelValue(install, "diff", registry.Boolean(False,
+                                  """In verbose mode, only announce the cards
+                                  that are new, changed or gone since the last
+                                  report"""))
+
+        conf.registerChannelValue(install, "digest",
+                                  registry.NonNegativeInteger(0, """In diff
+                                  mode, how often in minutes to report every
+                                  card anyway.  0 means never."""))
         if trelloid == "":
             trelloid = self.registryValue("lists." + name + ".list_id")
-        if self.trello is not None:
-            url = "https://trello.com/b/" + self.trello.lists.get_board(trelloid)['shortLink']
-            self.setRegistryValue("lists." + name + ".url", url)
+        shortlink = self.cache.get('shortLink:' + trelloid)
+        if shortlink is not None:
+            self.setRegistryValue("lists." + name + ".url",
+                                  "https://trello.com/b/" + shortlink)
+        return shortlink is not None
+
+    def resolve_urls(self, names, client=None):
+        '''look up the board links of lists, all at once, and store them in
+        their url values'''
+        client = client or self.client
+        listids = [self.registryValue("lists." + name + ".list_id")
+                   for name in names]
+        links = client.map(
+            lambda listid: client.attempt(client.get_list_board_shortlink,
+                                          listid) if listid else None,
+            listids)
+        for (name, link) in zip(names, links):
+            if link is not None:
+                self.setRegistryValue("lists." + name + ".url",
+                                      "https://trello.com/b/" + link)
+
+    def resolve_in_background(self, names):
+        '''resolve_urls on a thread, through a client of its own that gives
+        up after resolveTimeout seconds, so a slow trello does not hold up
+        loading the plugin or the first check'''
+        if not names:
+            return
+        client = TrelloClient(self.registryValue('trelloApi'),
+                              self.registryValue('trelloToken'),
+                              self.registryValue('trelloUrl'),
+                              self.registryValue('concurrency'),
+                              cache=self.cache, retries=0,
+                              timeout=self.registryValue('resolveTimeout'),
+                              metrics=self.metrics)
+
+        def resolve():
+            try:
+                self.resolve_urls(names, client)
+            finally:
+                client.close()
+        self.resolver = threading.Thread(target=resolve,
+                                         name=self.name() + ' resolver')
+        self.resolver.daemon = True
+        self.resolver.start()
 
     def get_custom_field_details(self, listid):
         '''get the custom field details'''
-        # get url from the list
-        self.debug("listid is " + str(listid))
-        baseurl = "https://api.trello.com/1/boards/"
-        auth_opts = {'key': self.registryValue('trelloApi'),
-                     'token': self.registryValue('trelloToken')}
-        self.debug("Auth Options passed:  " + str(auth_opts))
-        boardid = self.trello.lists.get(listid, fields='idBoard')['idBoard']
-        self.debug("found this board id:  " + str(boardid))
-        r = requests.get(baseurl + boardid + '/customFields', params=auth_opts)
-        self.debug("status code returned:  " + str(r.status_code))
-        return r.json()
+        self.debug("listid is %s", listid)
+        boardid = self.client.get_list_board(listid)
+        self.debug("found this board id:  %s", boardid)
+        return self.client.get_board_custom_fields(boardid)
 
     def get_card_custom_fields(self, card):
-        baseurl = 'https://api.trello.com/1/cards/'
-        auth_opts = {'key': self.registryValue('trelloApi'),
-                     'token': self.registryValue('trelloToken'),
-                     'customFieldItems': 'true'}
-        r = requests.get(baseurl + card, params=auth_opts)
-        return r.json()['customFieldItems']
+        return self.client.get_card_custom_fields(card)
 
     def addlist(self, irc, msg, args, name, trelloid):
         '''<name> <trello_id>
         Adds a new list that can be monitored'''
+        boardid = self.cache.get('board:' + trelloid)
+        self.cache.invalidate('board:' + trelloid, 'shortLink:' + trelloid,
+                              'customFields:%s' % boardid)
         self.register_list(name, trelloid)
         lists = self.registryValue('lists')
         lists.append(name.lower())
         self.setRegistryValue('lists', lists)
+        self.resolve_urls([name.lower()])
         irc.replySuccess()
     addlist = wrap(addlist, ['admin',
                              'somethingwithoutspaces',
@@ -205,170 +912,358 @@ class TrelloMon(callbacks.Plugin):
         result = []
         if list is None or list == "":
             return result
-        cards = self.trello.lists.get_card(list, fields="name,shortLink,shortUrl,labels")
-        self.debug("found %d cards" % len(cards))
-        for card in cards:
-            card['customFieldItems'] = self.get_card_custom_fields(card['shortLink'])
+        cards = self.client.get_list_cards(list)
+        self.debug("found %d cards", len(cards))
         return cards
 
     def check_labels(self, card_labels, valid_labels):
-        names = [label['name'] for label in card_labels]
-        for i in valid_labels:
-            for label in names:
-                if i.upper() in label.upper():
-                    return True
-        return False
+        return self.label_matcher(valid_labels).matches(
+            [label['name'].upper() for label in card_labels])
+
+    def label_matcher(self, valid_labels):
+        '''the LabelMatcher for a list of label patterns'''
+        key = LabelMatcher.normalize(valid_labels)
+        matcher = self.matchers.get(key)
+        if matcher is None:
+            matcher = self.matchers[key] = LabelMatcher(valid_labels)
+        return matcher
 
     def get_custom_field_value(self, field, custom_field_info):
-        for cf in custom_field_info:
-            if field['idCustomField'] == cf['id']:
-                if cf['type'] == 'list':
-                   for option in cf['options']:
-                        if option['id'] == field['idValue']:
-                            return str(option['value']['text'])
-                elif cf['type'] == 'text':
-                    return str(entry['value']['text'])
-                elif cf['type'] == 'checkbox':
-                    return str(field['value']['checked'])
-        return None
-
-    def _deref_custom(self, basestr, custom_info, card):
-        ''' pass in the base string, custom field info and a card
-        and handle replacing all the variables in basestr with the appropriate
-        variables from the card'''
-        p = re.compile(r'\${\w+}')
-        self.debug("base message:  " + basestr)
-        for match in p.finditer(basestr):
-            #get the right substring without the ${} wrapper
-            variable=match.group()[2:-1]
-            self.debug("match:  " + str(variable))
-            custom_field = None
-            # get the custom field id
-            for field in custom_info:
-                self.debug("checking custom field:  " + field['name'])
-                if field['name'] == variable:
-                    custom_field = field
-                    self.debug("found custom_field: " + field['name'])
-                    break
-            if custom_field is None:
-                basestr = basestr.replace(match.group(), "N/A")
-            else:
-                value = None
-                for entry in card['customFieldItems']:
-                    if entry['idCustomField'] == custom_field['id']:
-                        value = self.get_custom_field_value(entry, custom_info)
-                basestr = basestr.replace(match.group(), str(value))
-        return basestr
+        return FieldIndex(custom_field_info).value(field)
+
+    def template(self, text):
+        '''the parsed Template for a precustom/postcustom string'''
+        template = self.templates.get(text)
+        if template is None:
+            template = self.templates[text] = Template(text)
+        return template
+
+    def custom_filter(self, text):
+        '''the parsed CustomFilter for a custom_field_filter string'''
+        custom_filter = self.filters.get(text)
+        if custom_filter is None:
+            custom_filter = self.filters[text] = CustomFilter(text)
+        return custom_filter
 
     def check_custom_filter(self, card, custom_filter, custom_field_info):
         '''return true if this card should be filtered out'''
-        if custom_filter is None or custom_filter == "":
-            self.debug("custom filter not set")
-            return False
-        for criteria in custom_filter.split(','):
-            (field_name, value) = criteria.split(':',1)
-            self.debug('custom field filter on field "%s" with value "%s"' % (field_name, value))
-            for cf in custom_field_info:
-                if cf['name'] == field_name:
-                    break
-            for field in card['customFieldItems']:
-                if field['idCustomField'] == cf['id']:
-                    if value == self.get_custom_field_value(field, custom_field_info):
-                        return False
-        return True
+        fields = FieldIndex(custom_field_info)
+        return not self.custom_filter(custom_filter or "").matches(
+            fields, fields.decode(card))
 
-    def check_trello(self):
-        '''based on plugin config, scan trello for cards in the specified lists'''
+    def fetch_snapshot(self, entries, max_age=None):
+        '''download every distinct list once for this cycle.  Returns
+        {list_id: (cards, custom field details)}.  In shard mode, a list
+        published by another bot in the last max_age[list_id] seconds is
+        taken from there.'''
+        listids = [self.registryValue('lists.' + entry + '.list_id')
+                   for entry in entries]
+        published = {}
+        if self.shards is not None:
+            # in shard mode other bots fetch some of the lists for us
+            (listids, published) = self.shard_lists(listids, max_age or {})
+        failures = self.client.failures
+        if not listids:
+            snapshot = Snapshot()
+        elif self.registryValue('incremental') or \
+                self.registryValue('webhook'):
+            snapshot = self.sync.fetch_lists(listids)
+        else:
+            snapshot = self.client.fetch_lists(listids)
+        if self.client.failures != failures:
+            self.log.warning("trello requests failed (%s), skipped: %s, "
+                             "reusing the last cards of: %s",
+                             self.client.last_error,
+                             ", ".join(listid for listid in listids
+                                       if listid not in snapshot) or "none",
+                             ", ".join(snapshot.stale) or "none")
+        self.debug("fetched %d lists", len(snapshot))
+        if self.shards is not None:
+            self.publish_lists(snapshot)
+            snapshot.update(published)
+        return snapshot
+
+    def channel_config(self, entry, chan):
+        '''the settings of a list for a channel.  They are read from the
+        registry once per cycle, so the report loops only touch plain
+        attributes.'''
+        config = self.configs.get((entry, chan))
+        if config is not None:
+            return config
+        prefix = "lists." + entry + "."
+        suffix = "." + chan
+        # if not active in that channel (default is false), nothing else
+        # is needed
+        if not self.registryValue(prefix + "active" + suffix):
+            config = INACTIVE
+        else:
+            # per-list labels merged with the channel's global ones
+            valid_labels = self.registryValue(prefix + "labels" + suffix).split(',') + \
+                self.registryValue('labels', chan).split(',')
+            config = ChannelConfig(
+                active=True,
+                interval=self.registryValue(prefix + "interval" + suffix) * 60,
+                labels=self.label_matcher(valid_labels),
+                custom_filter=self.custom_filter(self.registryValue(prefix + "custom_field_filter" + suffix)),
+                precustom=self.template(self.registryValue(prefix + "precustom" + suffix)),
+                postcustom=self.template(self.registryValue(prefix + "postcustom" + suffix)),
+                showlabels=self.registryValue('showlabels', chan),
+                verbose=self.registryValue(prefix + "verbose" + suffix),
+                message=self.registryValue(prefix + "AlertMessage" + suffix),
+                url=self.registryValue(prefix + "url"),
+                diff=self.registryValue(prefix + "diff" + suffix),
+                digest=self.registryValue(prefix + "digest" + suffix) * 60)
+        self.configs[(entry, chan)] = config
+        return config
+
+    def plan_cycle(self, entries, now):
+        '''work out, before any HTTP, where each list has to be reported
+        now.  Returns ({entry: [(irc, channel, config)]}, {entry: seconds
+        until it falls due again on one of its channels}); entries with no
+        active channel are left out of the latter'''
+        due = {}
+        waits = {}
         # for each irc network in the bot
-        self.debug("starting check_trello")
         for irc in world.ircs:
             # for each list in the definition
-            for entry in self.registryValue('lists'):
-                self.debug("list:  " + str(entry))
-                # collect custom field info
-                custom_fields = self.get_custom_field_details(self.registryValue('lists.' + entry + '.list_id'))
-                # Collect all the list info first
-                results = self.get_trello_cards(self.registryValue('lists.' + entry + '.list_id'))
+            for entry in entries:
                 # for each channel the bot is in
                 for chan in irc.state.channels:
-                    self.debug("channel  " + str(chan))
-                    # if not active in that channel (default is false), then
-                    # do nothing
-                    if not self.registryValue("lists." + entry + ".active." + chan):
-                        self.debug("not active in chan: " + chan)
+                    config = self.channel_config(entry, chan)
+                    if not config.active:
                         continue
-                    # if no last_run time set, then set it
-                    if entry + "_" + chan not in self.last_run:
-                        self.debug("no last run")
-                        self.last_run[entry + "_" + chan] = time.mktime(time.gmtime())
-                    # compare last run time to current time to interval
-                    # if less than interval, next
-                    elif (float(time.mktime(time.gmtime()) - self.last_run[entry + "_" + chan]) <
-                          float(self.registryValue("lists." + entry + ".interval." + chan) * 60)):
-                        self.debug("last run too recent")
-                        continue
-                    # if greater than interval, update
-                    self.debug("last run too old or no last run")
-                    self.last_run[entry + "_" + chan] = time.mktime(time.gmtime())
-
-                    # Filter out some cards from the list only for this channel
-                    chan_set = []
-                    try:
-                        valid_labels = self.registryValue('lists.' + entry + '.labels.' + chan).split(',')
-                        for glabel in self.registryValue('labels', chan).split(','):
-                            if glabel not in valid_labels:
-                                valid_labels.append(glabel)
-                    except:
-                        valid_labels = []
-                    if '' in valid_labels:
-                        valid_labels.remove('')
-                    self.debug('valid labels:  ' + str(valid_labels))
-
-                    for card in results:
-                        # filter by custom fields
-                        self.debug("custom field filter is:  " + self.registryValue('lists.' + entry + '.custom_field_filter.' + chan))
-                        if self.check_custom_filter(card, self.registryValue('lists.' + entry + '.custom_field_filter.' + chan), custom_fields):
-                            self.debug("skipping %s due to custom field filter" % card['name'])
-                            continue
-                        if valid_labels != [] and not self.check_labels(card['labels'], valid_labels):
-                            self.debug("skipping %s due to valid_labels" %
-                                       card['name'])
-                            continue
-                        chan_set.append(card)
-
-                    message = self.registryValue("lists." + entry + ".AlertMessage." + chan)
-                    if chan_set == []:
-                        if entry + "_" + chan + "_count" in self.last_run and self.last_run[entry + "_" + chan + "_count"] != 0:
-                            self._send(message + " ALL CLEAR!!!", chan, irc)
-                        self.last_run[entry + "_" + chan + "_count"] = 0
-                        self.debug("no results")
-                        continue
-                    # check verbose setting per channel -- defaults to false
-                    self.last_run[entry + "_" + chan + "_count"] = len(chan_set)
-                    self.debug("verbose is " + str(self.registryValue("lists." + entry + '.verbose.' + chan)))
-                    if self.registryValue("lists." + entry + ".verbose." + chan):
-                        self.debug("verbose")
-                        for card in chan_set:
-                            # Build the message in the format:  <Alert> <precustom> <details> <postcustom> <labels>
-                            precustom = self._deref_custom(self.registryValue('lists.' + entry + '.precustom.' + chan), custom_fields, card)
-                            postcustom = self._deref_custom(self.registryValue('lists.' + entry + '.postcustom.' + chan), custom_fields, card)
-                            if self.registryValue('showlabels', chan):
-                                if len(card['labels']) == 0:
-                                    labelmsg = "  Labels:  None"
-                                else:
-                                    labellist = []
-                                    for label in card['labels']:
-                                        labellist.append(label['name'])
-                                    labelmsg = "  Labels: " + ",".join(labellist)
-                            else:
-                                labelmsg = ""
-
-                            self._send(message + " " + precustom + " " +
-                                       card['name'] + " -- " + card['shortUrl'] +
-                                       " " + postcustom + labelmsg, chan, irc)
+                    state = self.states.get((irc.network, entry, chan))
+                    # compare last run time to current time to interval, no
+                    # last run time means it is due right away
+                    left = 0
+                    if state is not None and state.last_run is not None:
+                        left = state.last_run + config.interval - now
+                    if left > 0:
+                        self.debug("last run too recent: %s %s", entry, chan)
                     else:
-                        self.debug("not verbose")
-                        self._send(message + " " + str(len(chan_set)) + ' cards in ' + entry + ' -- ' + self.registryValue('lists.' + entry + '.url'), chan, irc)
+                        due.setdefault(entry, []).append((irc, chan, config))
+                        left = 0
+                    if entry not in waits or left < waits[entry]:
+                        waits[entry] = left
+        return due, waits
+
+    def check_lists(self, entries):
+        '''fetch the lists of entries that are due, each once, and report
+        them to their channels.  Returns the due entries that could not be
+        fetched.'''
+        (due, waits) = self.plan_cycle(entries, time.mktime(time.gmtime()))
+        self.debug("lists due:  %s", sorted(due))
+        start = time.time()
+        missed = []
+        # a list is reported at most its shortest interval late
+        max_age = {}
+        for (entry, targets) in due.items():
+            listid = self.registryValue('lists.' + entry + '.list_id')
+            age = min(config.interval for (irc, chan, config) in targets)
+            max_age[listid] = min(age, max_age.get(listid, age))
+        try:
+            # fetch phase: every due list is downloaded once, whatever the
+            # number of networks and channels it is reported to
+            snapshot = self.fetch_snapshot([entry for entry in entries
+                                            if entry in due], max_age)
+            # fan-out phase
+            for entry in entries:
+                listid = self.registryValue('lists.' + entry + '.list_id')
+                if entry not in due:
+                    continue
+                if listid not in snapshot:
+                    missed.append(entry)
+                    continue
+                self.debug("list:  %s", entry)
+                cardset = CardSet(*snapshot[listid])
+                self.index[listid] = CardIndex(cardset)
+                for (irc, chan, config) in due[entry]:
+                    self.report_list(irc, chan, entry, cardset, config)
+        finally:
+            self.flush_outbox()
+            self.save_state()
+            self.save_cache()
+            self.metrics.observe('trellomon_phase_seconds',
+                                 time.time() - start, phase='cycle')
+            self.write_metrics()
+        return missed
+
+    def check_trello(self):
+        '''based on plugin config, scan trello for cards in the specified
+        lists that are due, then reschedule the list jobs'''
+        self.debug("starting check_trello")
+        try:
+            # settings are read afresh every cycle
+            self.configs = {}
+            self.configure_outbox()
+            self.check_lists(self.registryValue('lists'))
+        finally:
+            self.schedule_jobs()
+
+    def report_list(self, irc, chan, entry, cardset, config):
+        '''report the cards of a list to a channel'''
+        self.debug("channel  %s", chan)
+        key = (irc.network, entry, chan)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = ChannelState()
+        state.last_run = time.mktime(time.gmtime())
+        self.dirty.add(key)
+
+        # Filter out some cards from the list only for this channel
+        chan_set = []
+        valid_labels = config.labels
+        custom_filter = config.custom_filter
+        self.debug("valid labels:  %s, custom field filter:  %s",
+                   valid_labels.patterns, custom_filter.text)
+        with self.metrics.timer('trellomon_phase_seconds', phase='filter',
+                                entry=entry, channel=chan):
+            for (card, values, labels) in cardset:
+                # filter by custom fields
+                if not custom_filter.matches(cardset.fields, values):
+                    self.debug("skipping %s due to custom field filter", card['name'])
+                    continue
+                if valid_labels and not valid_labels.matches(labels):
+                    self.debug("skipping %s due to valid_labels", card['name'])
+                    continue
+                chan_set.append((card, values, labels))
+
+        message = config.message
+        if chan_set == []:
+            if state.count:
+                self._send(message + " ALL CLEAR!!!", chan, irc)
+            state.count = 0
+            state.cards = None
+            self.debug("no results")
+            return
+        # check verbose setting per channel -- defaults to false
+        state.count = len(chan_set)
+        self.debug("verbose is %s", config.verbose)
+        if not config.verbose:
+            self._send(message + " " + str(len(chan_set)) + ' cards in ' + entry + ' -- ' + config.url, chan, irc)
+        else:
+            with self.metrics.timer('trellomon_phase_seconds',
+                                    phase='render', entry=entry,
+                                    channel=chan):
+                if config.diff:
+                    lines = self.report_changes(state, cardset, chan_set,
+                                                config)
+                else:
+                    lines = [self.card_line(card, values, cardset, config)
+                             for (card, values, labels) in chan_set]
+            self._send_lines(lines, chan, irc)
+
+    def card_line(self, card, values, cardset, config, tag=""):
+        '''Build the message in the format:  <Alert> <precustom> <details> <postcustom> <labels>'''
+        precustom = config.precustom.render(cardset.fields, values)
+        postcustom = config.postcustom.render(cardset.fields, values)
+        if config.showlabels:
+            if len(card['labels']) == 0:
+                labelmsg = "  Labels:  None"
+            else:
+                labellist = []
+                for label in card['labels']:
+                    labellist.append(label['name'])
+                labelmsg = "  Labels: " + ",".join(labellist)
+        else:
+            labelmsg = ""
+        return (config.message + tag + " " + precustom + " " +
+                card['name'] + " -- " + card['shortUrl'] +
+                " " + postcustom + labelmsg)
+
+    def card_signature(self, card, values, cardset, config):
+        '''a checksum of everything card_line would show, without
+        rendering it'''
+        parts = [card['name'], card['shortUrl']]
+        for template in (config.precustom, config.postcustom):
+            for (literal, fieldid) in template.plan(cardset.fields):
+                if fieldid is not None:
+                    parts.append(str(values.get(fieldid)))
+        if config.showlabels:
+            parts.extend(label['name'] for label in card['labels'])
+        return zlib.crc32("\x00".join(parts).encode('utf-8'))
+
+    def report_changes(self, state, cardset, chan_set, config):
+        '''the lines announcing only the cards that are new, changed or gone
+        since the last report, or every card when a digest is due'''
+        now = time.mktime(time.gmtime())
+        previous = state.cards
+        current = {}
+        for (card, values, labels) in chan_set:
+            current[card['id']] = (self.card_signature(card, values, cardset, config),
+                                   card['name'], card['shortUrl'])
+        state.cards = current
+        if previous is None or (config.digest and
+                                now - (state.digest or 0) >= config.digest):
+            self.debug("full digest")
+            state.digest = now
+            return [self.card_line(card, values, cardset, config)
+                    for (card, values, labels) in chan_set]
+        lines = []
+        for (card, values, labels) in chan_set:
+            old = previous.get(card['id'])
+            if old is None:
+                lines.append(self.card_line(card, values, cardset, config, " NEW:"))
+            elif old[0] != current[card['id']][0]:
+                lines.append(self.card_line(card, values, cardset, config, " CHANGED:"))
+        for cardid in [cardid for cardid in previous if cardid not in current]:
+            (signature, name, url) = previous[cardid]
+            lines.append(config.message + " REMOVED: " + name + " -- " + url)
+        return lines
+
+    def cards(self, irc, msg, args, entry, terms):
+        '''<list> [label:<label>] [<field>:<value>] [<text>]
+
+        Search the cards of <list> as last fetched, without asking trello.
+        label: terms match like the labels setting, <field>:<value> terms
+        like custom_field_filter, and every other word has to appear in the
+        card name.  The answer goes to you only, and only if you are in a
+        channel the list is reported to.'''
+        entry = entry.lower()
+        if entry not in self.registryValue('lists'):
+            irc.error("%s is not a monitored list" % entry, private=True)
+            return
+        if not self.may_search(irc, msg, entry):
+            irc.error("%s is not reported to any channel you are in" % entry,
+                      private=True)
+            return
+        index = self.index.get(self.registryValue('lists.' + entry + '.list_id'))
+        if index is None:
+            irc.reply("the cards of %s have not been fetched yet" % entry,
+                      private=True)
+            return
+        labels = []
+        criteria = []
+        words = []
+        for term in terms:
+            (name, colon, value) = term.partition(':')
+            if colon and name.lower() == 'label':
+                labels.append(value)
+            elif colon:
+                criteria.append(term)
+            else:
+                words.extend(term.split())
+        found = index.search(self.label_matcher(labels) if labels else None,
+                             self.custom_filter(",".join(criteria)), words)
+        if not found:
+            irc.reply("no matching cards in %s" % entry, private=True)
+            return
+        irc.reply("%d of %d cards in %s: %s" % (
+            len(found), len(index), entry,
+            " | ".join(card['name'] + " -- " + card['shortUrl']
+                       for (card, values, labels) in found)), private=True)
+    cards = wrap(cards, ['somethingwithoutspaces', any('something')])
+
+    def may_search(self, irc, msg, entry):
+        '''whether the sender of msg may see the cards of entry: an admin,
+        or someone in one of our channels the list is active in'''
+        if ircdb.checkCapability(msg.prefix, 'admin'):
+            return True
+        for (chan, state) in irc.state.channels.items():
+            if msg.nick in state.users and \
+                    self.channel_config(entry, chan).active:
+                return True
+        return False
 
     def execute_wrapper(self, irc, msgs, args):
         '''admin test script for the monitor command'''
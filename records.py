@@ -0,0 +1,140 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Compact card records.  A Card keeps only the fields the monitor reads, in
+slots rather than a dict.  Labels are shared between all the cards that
+carry them, and custom field items are cut down to the field and its value.
+Cards still read like the json dicts they are made from: card['name'],
+card.get('pos') and 'labels' in card work as before.
+"""
+
+import sys
+
+# What is kept of a card, a label and a custom field item
+CARD_FIELDS = ('id', 'name', 'shortLink', 'shortUrl', 'idBoard', 'idList',
+               'pos', 'labels', 'customFieldItems')
+LABEL_FIELDS = ('id', 'name', 'color')
+ITEM_FIELDS = ('idCustomField', 'idValue', 'value')
+
+# {label tuple: label dict}.  The dicts are shared, so they are never
+# changed in place; an updated label is a new one.
+_labels = {}
+
+
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def compact_label(label):
+    '''the shared dict for a label with only LABEL_FIELDS'''
+    key = tuple(_intern(label.get(field)) for field in LABEL_FIELDS)
+    shared = _labels.get(key)
+    if shared is None:
+        shared = _labels.setdefault(key, dict(
+            (field, value) for (field, value) in zip(LABEL_FIELDS, key)
+            if field in label))
+    return shared
+
+
+def compact_item(item):
+    '''a customFieldItem with only ITEM_FIELDS'''
+    return dict((field, _intern(item[field]) if field != 'value'
+                 else item[field])
+                for field in ITEM_FIELDS if field in item)
+
+
+class Card(object):
+    '''the CARD_FIELDS of a card, read and set like a dict'''
+
+    __slots__ = CARD_FIELDS
+
+    def __init__(self, card):
+        for field in CARD_FIELDS:
+            if field in card:
+                setattr(self, field, card[field])
+        if 'idBoard' in card:
+            self.idBoard = _intern(card['idBoard'])
+        if 'idList' in card:
+            self.idList = _intern(card['idList'])
+        if 'labels' in card:
+            self.labels = [compact_label(label) for label in card['labels']]
+        if 'customFieldItems' in card:
+            self.customFieldItems = [compact_item(item) for item
+                                     in card['customFieldItems']]
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in CARD_FIELDS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [field for field in CARD_FIELDS if hasattr(self, field)]
+
+    def __eq__(self, other):
+        if isinstance(other, Card):
+            other = dict((key, other[key]) for key in other.keys())
+        return dict((key, self[key]) for key in self.keys()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return dict((key, self[key]) for key in self.keys())
+
+    def __setstate__(self, state):
+        for (key, value) in state.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return 'Card(%r)' % self.__getstate__()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,220 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Card rendering and filtering helpers.  Custom field definitions are indexed
+once per board and each card's custom field values and upper-cased label
+names are worked out once per fetch.  The precustom/postcustom templates,
+the custom_field_filter strings and the label lists are compiled once, so
+rendering or filtering a card is a single pass with dict lookups.
+"""
+
+import re
+
+FIELD_RE = re.compile(r'\${\w+}')
+
+
+class FieldIndex(object):
+    '''custom field definitions of a board indexed by id and by name, and
+    the texts of list field options indexed by option id'''
+
+    def __init__(self, custom_fields):
+        self.byid = {}
+        self.byname = {}
+        self.options = {}
+        for field in custom_fields:
+            self.byid[field['id']] = field
+            self.byname.setdefault(field['name'], field)
+            for option in field.get('options', ()):
+                self.options[option['id']] = str(option['value']['text'])
+        self.key = tuple((field['id'], field['name'])
+                         for field in custom_fields)
+
+    def value(self, item):
+        '''the text of one customFieldItem, or None'''
+        field = self.byid.get(item['idCustomField'])
+        if field is None:
+            return None
+        if field['type'] == 'list':
+            return self.options.get(item.get('idValue'))
+        elif field['type'] == 'text':
+            return str(item['value']['text'])
+        elif field['type'] == 'checkbox':
+            return str(item['value']['checked'])
+        return None
+
+    def decode(self, card):
+        '''{custom field id: text} for the items of a card'''
+        values = {}
+        for item in card['customFieldItems']:
+            values[item['idCustomField']] = self.value(item)
+        return values
+
+
+class CardSet(object):
+    '''the cards of one list with their custom field values decoded once
+    for every channel they are reported to'''
+
+    def __init__(self, cards, custom_fields):
+        self.cards = cards
+        self.custom_fields = custom_fields
+        self.fields = FieldIndex(custom_fields)
+        self.values = [self.fields.decode(card) for card in cards]
+        self.labels = [tuple(label['name'].upper() for label in card['labels'])
+                       for card in cards]
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        '''(card, values, upper-cased label names) for every card'''
+        return iter(zip(self.cards, self.values, self.labels))
+
+
+class Template(object):
+    '''a precustom/postcustom string split into literal text and ${field}
+    references.  Plans resolving the references against a board's fields
+    are kept per FieldIndex.key.'''
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        pos = 0
+        for match in FIELD_RE.finditer(text):
+            self.parts.append((text[pos:match.start()], match.group()[2:-1]))
+            pos = match.end()
+        self.tail = text[pos:]
+        self.plans = {}
+
+    def plan(self, fields):
+        '''[(literal, custom field id or None)] with unknown fields already
+        replaced by N/A'''
+        plan = self.plans.get(fields.key)
+        if plan is not None:
+            return plan
+        plan = []
+        literal = ''
+        for (text, name) in self.parts:
+            literal += text
+            field = fields.byname.get(name)
+            if field is None:
+                literal += 'N/A'
+            else:
+                plan.append((literal, field['id']))
+                literal = ''
+        plan.append((literal + self.tail, None))
+        self.plans[fields.key] = plan
+        return plan
+
+    def render(self, fields, values):
+        '''the template filled in from a card's decoded values'''
+        out = []
+        for (literal, fieldid) in self.plan(fields):
+            out.append(literal)
+            if fieldid is not None:
+                out.append(str(values.get(fieldid)))
+        return ''.join(out)
+
+
+class CustomFilter(object):
+    '''a custom_field_filter string ("Field:Value,Field:Value") parsed
+    once.  A card matches when any criterion matches; an empty filter
+    matches every card.  Criteria naming a field the board does not have
+    never match.'''
+
+    def __init__(self, text):
+        self.text = text
+        self.criteria = []
+        for criterion in text.split(','):
+            if ':' in criterion:
+                self.criteria.append(tuple(criterion.split(':', 1)))
+        self.plans = {}
+
+    def plan(self, fields):
+        '''{custom field id: set of wanted texts}'''
+        plan = self.plans.get(fields.key)
+        if plan is not None:
+            return plan
+        plan = {}
+        for (name, value) in self.criteria:
+            field = fields.byname.get(name)
+            if field is not None:
+                plan.setdefault(field['id'], set()).add(value)
+        self.plans[fields.key] = plan
+        return plan
+
+    def matches(self, fields, values):
+        '''whether a card with the decoded values passes the filter'''
+        if not self.text:
+            return True
+        for (fieldid, wanted) in self.plan(fields).items():
+            if values.get(fieldid) in wanted:
+                return True
+        return False
+
+
+class LabelMatcher(object):
+    '''matches card labels containing any of a list of patterns, ignoring
+    case.  A board only has a handful of distinct labels, so the answer
+    for each label name is worked out once, with a single regex over all
+    the patterns, and remembered.  Checking a card then costs one dict
+    lookup per label whatever the number of patterns.'''
+
+    def __init__(self, patterns):
+        self.patterns = self.normalize(patterns)
+        self.regex = re.compile('|'.join(re.escape(p) for p in self.patterns))
+        self.known = {}
+
+    @staticmethod
+    def normalize(patterns):
+        return tuple(sorted(set(p.upper() for p in patterns if p)))
+
+    def __bool__(self):
+        return bool(self.patterns)
+    __nonzero__ = __bool__
+
+    def match(self, name):
+        '''whether one upper-cased label name matches'''
+        found = self.known.get(name)
+        if found is None:
+            found = self.known[name] = self.regex.search(name) is not None
+        return found
+
+    def matches(self, names):
+        '''whether any of a card's upper-cased label names matches'''
+        if not self.patterns:
+            return False
+        for name in names:
+            if self.match(name):
+                return True
+        return False
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,230 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Shard mode: several bots sharing the monitored lists through one SQLite
+file.  Each bot renews a claim on the lists it monitors.  Every list is
+leased to one of the bots claiming it, picked by rendezvous hashing so the
+lists spread evenly and only move when bots come or go.  The lease holder
+alone fetches the list from trello and publishes the cards; the other bots
+report from the published copy while it is no older than their interval for
+the list, and fetch it themselves otherwise.  A bot that stops renewing loses
+its leases when they expire, and its lists go to the bots still claiming
+them.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+try:
+    from .records import Card
+except ImportError:
+    # imported as a top-level module by the shard test workers
+    from records import Card
+
+SCHEMA = ('''CREATE TABLE IF NOT EXISTS wants (
+    key TEXT NOT NULL,
+    member TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (key, member))''',
+          '''CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    member TEXT NOT NULL,
+    expires REAL NOT NULL)''',
+          '''CREATE TABLE IF NOT EXISTS snapshots (
+    key TEXT PRIMARY KEY,
+    member TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    data TEXT NOT NULL)''')
+
+
+def rank(member, key):
+    '''how much member wants key: the highest ranked claimant gets it.  The
+    same in every process, unlike hash().'''
+    digest = hashlib.md5((key + '\0' + member).encode('utf-8')).hexdigest()
+    return int(digest, 16)
+
+
+class ShardStore(object):
+    '''the leases and published snapshots of member, one of the bots
+    sharing filename.  Claims and leases last lease seconds.'''
+
+    def __init__(self, filename, member, lease=120):
+        self.filename = filename
+        self.member = member
+        self.lease = lease
+        # keys leased to us by the latest claims
+        self.owned = set()
+        # {key: (fetched, snapshot)} of the snapshots read so far
+        self.seen = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=30,
+                             isolation_level=None)
+        for table in SCHEMA:
+            db.execute(table)
+        return db
+
+    def _transaction(self, func):
+        '''func(db) in a write transaction, so bots take turns'''
+        with self._lock:
+            with closing(self._connect()) as db:
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    result = func(db)
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+                return result
+
+    def claim(self, keys, now=None):
+        '''renew our claim on keys and return the ones leased to us.  A key
+        is taken when we are its highest ranked live claimant and nobody
+        else holds it; one held by us that ranks another claimant higher is
+        let go, for that one to take.'''
+        now = time.time() if now is None else now
+        keys = sorted(set(keys))
+
+        def claim(db):
+            expires = now + self.lease
+            db.executemany('INSERT OR REPLACE INTO wants VALUES (?, ?, ?)',
+                           [(key, self.member, expires) for key in keys])
+            db.execute('DELETE FROM wants WHERE expires <= ?', (now,))
+            claimants = {}
+            for (key, member) in db.execute('SELECT key, member FROM wants'):
+                claimants.setdefault(key, []).append(member)
+            leases = dict((key, (member, until)) for (key, member, until)
+                          in db.execute('SELECT key, member, expires '
+                                        'FROM leases'))
+            owned = set()
+            for key in keys:
+                first = max(claimants[key],
+                            key=lambda member: rank(member, key))
+                (holder, until) = leases.get(key, (None, 0))
+                if first == self.member and (holder == self.member or
+                                             until <= now):
+                    db.execute('INSERT OR REPLACE INTO leases '
+                               'VALUES (?, ?, ?)',
+                               (key, self.member, expires))
+                    owned.add(key)
+                elif holder == self.member:
+                    db.execute('DELETE FROM leases WHERE key = ?', (key,))
+            return owned
+        owned = self._transaction(claim)
+        self.owned.difference_update(keys)
+        self.owned.update(owned)
+        return owned
+
+    def release(self):
+        '''give up every claim and lease, for the other bots to take over
+        at once'''
+        def release(db):
+            db.execute('DELETE FROM wants WHERE member = ?', (self.member,))
+            db.execute('DELETE FROM leases WHERE member = ?', (self.member,))
+        self._transaction(release)
+        self.owned = set()
+
+    def publish(self, snapshots, now=None):
+        '''store {key: (cards, custom fields)} for the other bots.  Only
+        keys still leased to us are written.'''
+        now = time.time() if now is None else now
+        rows = []
+        for (key, (cards, fields)) in snapshots.items():
+            data = json.dumps([[dict((name, card[name])
+                                     for name in card.keys())
+                                for card in cards], fields],
+                              separators=(',', ':'))
+            rows.append((key, self.member, now, data, key, self.member))
+        if not rows:
+            return
+        self._transaction(lambda db: db.executemany(
+            'INSERT OR REPLACE INTO snapshots SELECT ?, ?, ?, ? WHERE '
+            'EXISTS (SELECT 1 FROM leases WHERE key = ? AND member = ?)',
+            rows))
+
+    def read(self, keys, max_age=None, now=None):
+        '''{key: (cards, custom fields)} published by the other bots for
+        keys.  A snapshot is only used while its bot still holds the lease,
+        or for lease seconds after it was fetched, and never once it is
+        older than max_age[key] seconds.'''
+        now = time.time() if now is None else now
+        keys = set(keys)
+        max_age = max_age or {}
+        result = {}
+        with self._lock:
+            with closing(self._connect()) as db:
+                leases = dict(db.execute('SELECT key, member FROM leases '
+                                         'WHERE expires > ?', (now,)))
+                rows = db.execute('SELECT key, member, fetched '
+                                  'FROM snapshots').fetchall()
+                for (key, member, fetched) in rows:
+                    if key not in keys or member == self.member:
+                        continue
+                    if leases.get(key) != member and \
+                            fetched <= now - self.lease:
+                        continue
+                    if key in max_age and fetched < now - max_age[key]:
+                        continue
+                    seen = self.seen.get(key)
+                    if seen is None or seen[0] != fetched:
+                        (data,) = db.execute(
+                            'SELECT data FROM snapshots WHERE key = ?',
+                            (key,)).fetchone()
+                        (cards, fields) = json.loads(data)
+                        seen = self.seen[key] = (
+                            fetched, ([Card(card) for card in cards], fields))
+                    result[key] = seen[1]
+        return result
+
+    def owners(self, now=None):
+        '''{key: member} of the live leases'''
+        now = time.time() if now is None else now
+        with self._lock:
+            with closing(self._connect()) as db:
+                return dict(db.execute('SELECT key, member FROM leases '
+                                       'WHERE expires > ?', (now,)))
+
+    def members(self, now=None):
+        '''the bots with a live claim, sorted'''
+        now = time.time() if now is None else now
+        with self._lock:
+            with closing(self._connect()) as db:
+                return [member for (member,) in db.execute(
+                    'SELECT DISTINCT member FROM wants WHERE expires > ? '
+                    'ORDER BY member', (now,))]
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
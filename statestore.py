@@ -0,0 +1,111 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Persistent monitoring state.  For every (network, list, channel) the time of
+the last report, the last card count, the time of the last digest and the
+cards last announced are kept in an SQLite database in the bot's data
+directory, so a restart carries on where it left off instead of reporting
+everything at once.
+"""
+
+import json
+import sqlite3
+import threading
+from contextlib import closing
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS channels (
+    network TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    last_run REAL,
+    count INTEGER,
+    digest REAL,
+    cards TEXT,
+    PRIMARY KEY (network, entry, channel))'''
+
+
+class ChannelState(object):
+    '''what is remembered about one list on one channel'''
+    __slots__ = ('last_run', 'count', 'digest', 'cards')
+
+    def __init__(self, last_run=None, count=None, digest=None, cards=None):
+        self.last_run = last_run
+        self.count = count
+        self.digest = digest
+        self.cards = cards
+
+
+class StateStore(object):
+    '''{(network, entry, channel): ChannelState} saved to filename.  Changes
+    are written in one transaction by save().'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename)
+        db.execute(SCHEMA)
+        return db
+
+    def load(self):
+        '''return every stored ChannelState'''
+        with self._lock:
+            with closing(self._connect()) as db:
+                rows = db.execute('SELECT network, entry, channel, last_run, '
+                                  'count, digest, cards FROM channels')
+                states = {}
+                for (network, entry, channel, last_run, count, digest,
+                     cards) in rows:
+                    if cards is not None:
+                        cards = dict((cardid, tuple(card)) for (cardid, card)
+                                     in json.loads(cards).items())
+                    states[(network, entry, channel)] = ChannelState(
+                        last_run, count, digest, cards)
+        return states
+
+    def save(self, states):
+        '''write {key: ChannelState} in one transaction'''
+        rows = []
+        for ((network, entry, channel), state) in states.items():
+            cards = None
+            if state.cards is not None:
+                cards = json.dumps(state.cards, separators=(',', ':'))
+            rows.append((network, entry, channel, state.last_run,
+                         state.count, state.digest, cards))
+        with self._lock:
+            with closing(self._connect()) as db:
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO channels '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
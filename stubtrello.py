@@ -0,0 +1,390 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Local stand-in for the parts of the Trello API the monitor uses.  It serves
+synthetic boards from memory and counts every request, so test.py and
+benchmark.py can run without network access.
+"""
+
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.serve(self.server.stub.handle)
+
+    def do_POST(self):
+        self.serve(self.server.stub.handle_post)
+
+    def serve(self, handle):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for (k, v) in parse_qs(url.query).items())
+        stub = self.server.stub
+        headers = stub.enter()
+        try:
+            if stub.latency:
+                time.sleep(stub.latency)
+            failure = stub.next_failure()
+            if failure is not None:
+                (status, retry_after) = failure
+                if retry_after is not None:
+                    headers['Retry-After'] = str(retry_after)
+                self.reply(status, {'message': 'injected failure'}, headers)
+            else:
+                self.reply(*handle(url.path, query), headers=headers)
+        finally:
+            stub.leave()
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubTrello(object):
+    '''In-memory Trello serving boards, lists, cards and custom fields.
+
+    latency delays every answer, fail() makes the next answers errors, and
+    budget sends trello's rate limit headers counting down from it.'''
+
+    def __init__(self, latency=0, budget=None):
+        self.latency = latency
+        self.budget = budget
+        self.failures = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.boards = {}
+        self.lists = {}
+        self.cards = {}
+        self.actions = []
+        self.webhooks = []
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def add_board(self, boardid, lists, labels=('DFG-Compute', 'Blocker'),
+                  dfgs=('Compute', 'Network', 'Storage')):
+        '''create a board with a list per {listid: card count} entry.  Every
+        board carries a DFG list field, an RCA text field and a Blocker
+        checkbox so templates and filters have something to chew on.'''
+        dfg_options = [{'id': '%s-dfg-%d' % (boardid, i),
+                        'value': {'text': text}}
+                       for (i, text) in enumerate(dfgs)]
+        fields = [{'id': boardid + '-cf-dfg', 'name': 'DFG', 'type': 'list',
+                   'options': dfg_options},
+                  {'id': boardid + '-cf-rca', 'name': 'RCA', 'type': 'text'},
+                  {'id': boardid + '-cf-blocker', 'name': 'Blocker',
+                   'type': 'checkbox'}]
+        self.boards[boardid] = {'id': boardid, 'shortLink': 'b' + boardid,
+                                'customFields': fields,
+                                'labels': dict((label, {'id': boardid + '-' +
+                                                        label,
+                                                        'name': label})
+                                               for label in labels)}
+        for (listid, count) in sorted(lists.items()):
+            self.lists[listid] = {'id': listid, 'idBoard': boardid,
+                                  'name': listid, 'cards': []}
+            for n in range(count):
+                self.add_card(listid, 'Card %d of %s' % (n, listid),
+                              labels=[labels[n % len(labels)]] if labels
+                              else [],
+                              dfg=dfg_options[n % len(dfg_options)]['id'],
+                              rca='rca %d' % n, blocker=(n % 2 == 0))
+
+    def add_card(self, listid, name, labels=(), dfg=None, rca=None,
+                 blocker=None):
+        boardid = self.lists[listid]['idBoard']
+        cardid = '%s-c%d' % (listid, len(self.cards))
+        items = []
+        if dfg is not None:
+            items.append({'id': cardid + '-dfg', 'idModel': cardid,
+                          'idCustomField': boardid + '-cf-dfg',
+                          'idValue': dfg})
+        if rca is not None:
+            items.append({'id': cardid + '-rca', 'idModel': cardid,
+                          'idCustomField': boardid + '-cf-rca',
+                          'value': {'text': rca}})
+        if blocker is not None:
+            items.append({'id': cardid + '-blocker', 'idModel': cardid,
+                          'idCustomField': boardid + '-cf-blocker',
+                          'value': {'checked': str(blocker).lower()}})
+        card = {'id': cardid, 'name': name, 'shortLink': 's' + cardid,
+                'shortUrl': 'https://trello.com/c/s' + cardid,
+                'idBoard': boardid, 'idList': listid,
+                'pos': len(self.lists[listid]['cards']) + 1,
+                'labels': [{'id': boardid + '-' + label, 'name': label}
+                           for label in labels],
+                'customFieldItems': items}
+        self.cards[cardid] = card
+        self.cards[card['shortLink']] = card
+        self.lists[listid]['cards'].append(card)
+        return card
+
+    def _action(self, kind, subject, **data):
+        '''record a board action on the subject card the way trello reports
+        it'''
+        data['card'] = dict(data.get('card', {}), id=subject['id'],
+                            shortLink=subject['shortLink'])
+        data['board'] = {'id': subject['idBoard']}
+        action = {'id': 'a%08d' % (len(self.actions) + 1), 'type': kind,
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                        time.gmtime()),
+                  'data': data, 'idBoard': subject['idBoard']}
+        self.actions.append(action)
+        return action
+
+    def create_card(self, listid, name, **kwargs):
+        card = self.add_card(listid, name, **kwargs)
+        self._action('createCard', card, card={'name': name},
+                     list={'id': listid})
+        return card
+
+    def move_card(self, cardid, listid):
+        card = self.cards[cardid]
+        old = card['idList']
+        self.lists[old]['cards'].remove(card)
+        self.lists[listid]['cards'].append(card)
+        card['idList'] = listid
+        self._action('updateCard', card, card={'idList': listid},
+                     old={'idList': old}, listBefore={'id': old},
+                     listAfter={'id': listid})
+
+    def move_list(self, listid, boardid):
+        '''move a list and its cards to another board'''
+        self.lists[listid]['idBoard'] = boardid
+        for card in self.lists[listid]['cards']:
+            card['idBoard'] = boardid
+
+    def archive_card(self, cardid):
+        card = self.cards[cardid]
+        self.lists[card['idList']]['cards'].remove(card)
+        self._action('updateCard', card, card={'closed': True},
+                     old={'closed': False}, list={'id': card['idList']})
+
+    def rename_card(self, cardid, name):
+        card = self.cards[cardid]
+        old = card['name']
+        card['name'] = name
+        self._action('updateCard', card, card={'name': name},
+                     old={'name': old}, list={'id': card['idList']})
+
+    def add_label(self, cardid, name):
+        card = self.cards[cardid]
+        label = {'id': card['idBoard'] + '-' + name, 'name': name}
+        card['labels'].append(label)
+        self._action('addLabelToCard', card, label=label)
+
+    def remove_label(self, cardid, name):
+        card = self.cards[cardid]
+        label = [l for l in card['labels'] if l['name'] == name][0]
+        card['labels'].remove(label)
+        self._action('removeLabelFromCard', card, label=label)
+
+    def set_custom_field(self, cardid, name, text):
+        '''set a custom field of a card by name to text, picking the option
+        for list fields'''
+        card = self.cards[cardid]
+        field = [f for f in self.boards[card['idBoard']]['customFields']
+                 if f['name'] == name][0]
+        item = {'id': cardid + '-' + name.lower(), 'idModel': cardid,
+                'idCustomField': field['id']}
+        if field['type'] == 'list':
+            item['idValue'] = [o['id'] for o in field['options']
+                               if o['value']['text'] == text][0]
+        elif field['type'] == 'checkbox':
+            item['value'] = {'checked': text}
+        else:
+            item['value'] = {'text': text}
+        card['customFieldItems'] = [i for i in card['customFieldItems']
+                                    if i['idCustomField'] != field['id']]
+        card['customFieldItems'].append(item)
+        self._action('updateCustomFieldItem', card, customFieldItem=item,
+                     customField={'id': field['id'], 'name': name})
+
+    def webhook_payload(self, action, callback):
+        '''the json body trello would POST to callback for action'''
+        board = self.boards[action['data']['board']['id']]
+        return json.dumps({'action': action,
+                           'model': {'id': board['id'],
+                                     'shortLink': board['shortLink']},
+                           'webhook': {'id': 'w' + board['id'],
+                                       'idModel': board['id'],
+                                       'callbackURL': callback}})
+
+    def _actions(self, boardid, query):
+        '''board actions newest first, honouring since, filter and limit'''
+        kinds = query.get('filter', 'all').split(',')
+        since = query.get('since')
+        actions = [a for a in self.actions if a['idBoard'] == boardid and
+                   ('all' in kinds or a['type'] in kinds) and
+                   (since is None or a['id'] > since)]
+        actions.reverse()
+        return actions[:int(query.get('limit', 50))]
+
+    def _card(self, card, query):
+        fields = query.get('fields')
+        if fields and fields != 'all':
+            result = dict((k, card[k]) for k in fields.split(',')
+                          if k in card)
+            result['id'] = card['id']
+        else:
+            result = dict(card)
+            del result['customFieldItems']
+        if query.get('customFieldItems') == 'true':
+            result['customFieldItems'] = card['customFieldItems']
+        return result
+
+    def fail(self, count=1, status=429, retry_after=None):
+        '''answer the next count requests with status'''
+        with self._lock:
+            self.failures.extend([(status, retry_after)] * count)
+
+    def next_failure(self):
+        with self._lock:
+            if self.failures:
+                return self.failures.pop(0)
+        return None
+
+    def enter(self):
+        '''count a request in flight and return the rate limit headers'''
+        headers = {}
+        with self._lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            if self.budget is not None:
+                self.budget = max(self.budget - 1, 0)
+                for name in ('key', 'token'):
+                    prefix = 'x-rate-limit-api-%s-' % name
+                    headers[prefix + 'remaining'] = str(self.budget)
+                    headers[prefix + 'interval-ms'] = '10000'
+        return headers
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def handle(self, path, query):
+        '''route a request and return (status, json body)'''
+        with self._lock:
+            self.requests.append(path)
+        parts = path.strip('/').split('/')[1:]
+        try:
+            kind, key = parts[0], parts[1]
+            rest = parts[2:]
+            if kind == 'lists':
+                lst = self.lists[key]
+                if not rest:
+                    return 200, {'id': key, 'idBoard': lst['idBoard'],
+                                 'name': lst['name']}
+                if rest == ['board']:
+                    board = self.boards[lst['idBoard']]
+                    return 200, {'id': board['id'],
+                                 'shortLink': board['shortLink']}
+                if rest == ['cards']:
+                    return 200, [self._card(c, query) for c in lst['cards']]
+            elif kind == 'boards':
+                board = self.boards[key]
+                if rest == ['customFields']:
+                    return 200, board['customFields']
+                if rest == ['actions']:
+                    return 200, self._actions(key, query)
+                if rest == ['cards']:
+                    return 200, [self._card(c, query)
+                                 for lst in self.lists.values()
+                                 if lst['idBoard'] == key
+                                 for c in lst['cards']]
+            elif kind == 'cards' and not rest:
+                return 200, self._card(self.cards[key], query)
+        except (IndexError, KeyError):
+            pass
+        return 404, {'message': 'not found'}
+
+    def handle_post(self, path, query):
+        with self._lock:
+            self.requests.append('POST ' + path)
+        if path.strip('/').split('/')[1:] == ['webhooks'] and \
+                query.get('idModel') in self.boards:
+            webhook = {'id': 'w%d' % len(self.webhooks),
+                       'idModel': query['idModel'],
+                       'callbackURL': query.get('callbackURL')}
+            self.webhooks.append(webhook)
+            return 200, webhook
+        return 400, {'message': 'invalid webhook'}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/1/' % self._server.server_address[1]
+
+    def reset(self):
+        '''forget the requests seen so far'''
+        with self._lock:
+            self.requests = []
+            self.max_inflight = 0
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -29,10 +29,992 @@
 ###
 
 from supybot.test import *
+import supybot.conf as conf
+import supybot.httpserver as httpserver
+import supybot.irclib as irclib
+import supybot.schedule as schedule
+import supybot.world as world
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import requests
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
 
+from .boardsync import BoardSync
+from .plugin import TrelloWebhook
+from .cache import TTLCache
+from .jsonstream import iter_array
+from .outqueue import OutQueue, pack
+from .shards import ShardStore
+from .stubtrello import StubTrello
+from .trelloclient import RateLimiter, TrelloClient
 
-class TrelloMonTestCase(PluginTestCase):
+
+# A bot of its own for testShardProcesses: claims the keys and publishes a
+# card named after itself for each one it gets, until killed
+SHARD_WORKER = '''
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from shards import ShardStore
+store = ShardStore(sys.argv[2], sys.argv[3], lease=float(sys.argv[4]))
+keys = sys.argv[5].split(',')
+while True:
+    owned = store.claim(keys)
+    store.publish(dict((key, ([{'id': key, 'name': sys.argv[3]}], []))
+                       for key in owned))
+    time.sleep(0.1)
+'''
+
+
+def wait_until(check, timeout=15):
+    '''poll check() until it returns something true, or fail'''
+    deadline = time.time() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.time() > deadline:
+            raise AssertionError('gave up waiting')
+        time.sleep(0.1)
+
+
+class FakeState(object):
+    def __init__(self, channels):
+        self.channels = dict((chan, None) for chan in channels)
+
+
+class FakeIrc(object):
+    '''just enough of an Irc object for check_trello's fan-out'''
+    def __init__(self, network, channels):
+        self.network = network
+        self.state = FakeState(channels)
+        self.msgs = []
+
+    def queueMsg(self, msg):
+        self.msgs.append(msg)
+
+
+class TrelloMonCase(PluginTestCase):
+    '''a TrelloMon bot talking to a StubTrello'''
     plugins = ('TrelloMon',)
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.stub = StubTrello().start()
+        self.stub.add_board('board1', {'list1': 5, 'list2': 3})
+        self.stub.add_board('board2', {'list3': 2})
+        conf.supybot.plugins.TrelloMon.trelloUrl.setValue(self.stub.url)
+        # one message per card, sent straight away
+        conf.supybot.plugins.TrelloMon.coalesce.setValue(False)
+        conf.supybot.plugins.TrelloMon.sendburst.setValue(1000)
+        conf.supybot.plugins.TrelloMon.stagger.setValue(0)
+        self.cb = self.irc.getCallback('TrelloMon')
+        self.cb.reload_trello()
+        self.ircs = world.ircs[:]
+
+    def tearDown(self):
+        world.ircs[:] = self.ircs
+        for name in ('incremental', 'webhook', 'webhookSecret', 'webhookUrl',
+                     'labels', 'showlabels', 'coalesce', 'sendrate',
+                     'sendburst', 'sendbacklog', 'stagger', 'metricsFile',
+                     'boardfetch', 'shardFile', 'shardName', 'shardLease'):
+            value = conf.supybot.plugins.TrelloMon.get(name)
+            value.setValue(value._default)
+            for child in list(value._children):
+                value.unregister(child)
+        self.forget_lists()
+        if os.path.exists(self.cb.state_file()):
+            os.remove(self.cb.state_file())
+        shards = conf.supybot.directories.data.dirize('shards.db')
+        if os.path.exists(shards):
+            os.remove(shards)
+        self.stub.stop()
+        PluginTestCase.tearDown(self)
+
+    def forget_lists(self):
+        lists = conf.supybot.plugins.TrelloMon.lists
+        for name in set(lists()):
+            lists.unregister(name)
+        lists.setValue([])
+
+    def monitor(self, name, listid, channels):
+        self.cb.register_list(name, listid)
+        self.cb.setRegistryValue('lists', self.cb.registryValue('lists') +
+                                 [name])
+        self.cb.setRegistryValue('lists.' + name + '.postcustom', '')
+        for chan in channels:
+            self.cb.setRegistryValue('lists.' + name + '.active', True,
+                                     channel=chan)
+
+    def expire(self, seconds=None):
+        '''make every list due again, or move every report seconds back'''
+        for state in self.cb.states.values():
+            if seconds is None:
+                state.last_run = None
+            else:
+                state.last_run -= seconds
+                if state.digest is not None:
+                    state.digest -= seconds
+
+    def networks(self, *names):
+        world.ircs[:] = [FakeIrc(name, ['#a', '#b']) for name in names]
+        return world.ircs
+
+
+class TrelloMonTestCase(TrelloMonCase):
+    def testFetchOncePerCycle(self):
+        self.monitor('new', 'list1', ['#a', '#b'])
+        self.monitor('triage', 'list2', ['#a'])
+        self.monitor('other', 'list3', ['#b'])
+        self.monitor('alias', 'list1', ['#b'])
+        ircs = self.networks('net1', 'net2', 'net3')
+        self.stub.reset()
+        self.cb.check_trello()
+        # three distinct lists plus one custom field fetch per board
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/1/boards/board1/customFields',
+                          '/1/boards/board2/customFields',
+                          '/1/lists/list1/cards',
+                          '/1/lists/list2/cards',
+                          '/1/lists/list3/cards'])
+        for irc in ircs:
+            # new: 5 cards x 2 chans, triage: 3, other: 2, alias: 5
+            self.assertEqual(len(irc.msgs), 20)
+
+    def testBoardFetch(self):
+        self.stub.add_board('board3', {'a': 2, 'b': 3, 'c': 4})
+        self.monitor('a', 'a', ['#a'])
+        self.monitor('b', 'b', ['#a'])
+        self.monitor('solo', 'list3', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        first = [m.args[1] for m in ircs[0].msgs]
+        # once the boards are known, board3 takes one request for both
+        # lists, and the unmonitored list c is left out
+        del ircs[0].msgs[:]
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/1/boards/board3/cards', '/1/lists/list3/cards'])
+        self.assertEqual([m.args[1] for m in ircs[0].msgs], first)
+        self.assertEqual(len(first), 7)
+        # a list moved to another board is found there, not taken for empty
+        self.stub.move_list('a', 'board2')
+        del ircs[0].msgs[:]
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/1/boards/board3/cards', '/1/lists/a/cards',
+                          '/1/lists/list3/cards'])
+        # the same cards, though board2 does not know board3's DFG field
+        self.assertEqual([m.args[1].split('Card ')[1] for m in ircs[0].msgs],
+                         [line.split('Card ')[1] for line in first])
+        self.assertEqual(self.cb.client.list_boards['a'], 'board2')
+        self.cb.setRegistryValue('boardfetch', 0)
+        self.cb.reload_trello()
+        self.stub.reset()
+        self.cb.client.fetch_lists(['a', 'b'])
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/1/lists/a/cards', '/1/lists/b/cards'])
+
+    def testSameChannelOnEveryNetwork(self):
+        self.monitor('new', 'list1', ['#a'])
+        ircs = self.networks('net1', 'net2')
+        self.cb.check_trello()
+        for irc in ircs:
+            self.assertEqual([m.args[0] for m in irc.msgs], ['#a'] * 5)
+
+    def testSkipListsNotDue(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.monitor('idle', 'list2', [])
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertNotIn('/1/lists/list2/cards', self.stub.requests)
+        self.assertEqual(len(ircs[0].msgs), 5)
+        # the default interval is 10 minutes, so nothing is due yet
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(len(ircs[0].msgs), 5)
+        wait = self.cb.next_check - time.time()
+        self.assertTrue(590 < wait <= 600, wait)
+
+    def testNextCheckFollowsInterval(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.cb.setRegistryValue('lists.new.interval', 2, channel='#a')
+        self.networks('net1')
+        self.cb.check_trello()
+        wait = self.cb.next_check - time.time()
+        self.assertTrue(110 < wait <= 120, wait)
+        self.assertRegexp('nextcheck', 'next check in 1[01][0-9] seconds')
+
+    def testListJobs(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.monitor('alias', 'list1', ['#b'])
+        self.monitor('other', 'list3', ['#a'])
+        self.cb.setRegistryValue('lists.other.interval', 2, channel='#a')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        # one job per board
+        self.assertEqual(sorted(self.cb.jobs), ['board1', 'board2'])
+        now = time.time()
+        self.assertTrue(590 < self.cb.jobs['board1'].next_run - now <= 600)
+        self.assertTrue(110 < self.cb.jobs['board2'].next_run - now <= 120)
+        # a job only checks its own lists
+        del ircs[0].msgs[:]
+        self.expire()
+        self.stub.reset()
+        self.cb.check_job(self.cb.jobs['board2'])
+        self.assertEqual(self.stub.requests, ['/1/lists/list3/cards'])
+        self.assertEqual(len(ircs[0].msgs), 2)
+        self.assertRegexp('listjobs', r'board1 \(new, alias\): next in 59\ds; '
+                          r'board2 \(other\): next in 1[01]\ds, last took')
+        # lists due at once are spread over the stagger window
+        self.cb.setRegistryValue('stagger', 30)
+        self.expire()
+        self.cb.schedule_jobs()
+        now = time.time()
+        self.assertTrue(-0.1 < self.cb.jobs['board1'].next_run - now < 15.1)
+        self.assertTrue(14.9 < self.cb.jobs['board2'].next_run - now < 30.1)
+
+    def testFailedJobBacksOff(self):
+        self.monitor('other', 'list3', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.setRegistryValue('stagger', 30)
+        self.cb.client.retries = 0
+        self.stub.fail(1000, 500)
+        self.cb.schedule_jobs()
+        job = self.cb.jobs['list3']
+        self.cb.check_job(job)
+        self.assertEqual(ircs[0].msgs, [])
+        # still due, but not retried within the stagger window
+        wait = job.next_run - time.time()
+        self.assertTrue(59 < wait <= 60, wait)
+        self.cb.check_job(job)
+        wait = job.next_run - time.time()
+        self.assertTrue(119 < wait <= 120, wait)
+        self.assertRegexp('listjobs', r'list3 \(other\): next in 1[01]\ds, '
+                          r'last took .*, 2 failed')
+        # trello is back: the list is reported and keeps its interval
+        with self.stub._lock:
+            del self.stub.failures[:]
+        # as run_job does
+        job.next_run = None
+        self.cb.check_job(job)
+        self.assertEqual(len(ircs[0].msgs), 2)
+        self.assertEqual(job.failures, 0)
+        # now that its board is known the list has a board job
+        self.assertEqual(list(self.cb.jobs), ['board2'])
+        self.assertTrue(self.cb.jobs['board2'].next_run - time.time() > 500)
+
+    def testKilledJobStaysStopped(self):
+        self.monitor('other', 'list3', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.schedule_jobs()
+        self.stub.latency = 1
+        self.cb.run_job('list3')
+        self.assertNoResponse('killagent', 1)
+        self.assertEqual(self.cb.jobs, {})
+        # the running check finishes but does not schedule itself again
+        timeout = time.time() + 5
+        while time.time() < timeout and len(ircs[0].msgs) < 2:
+            time.sleep(0.1)
+        time.sleep(0.2)
+        self.assertEqual(len(ircs[0].msgs), 2)
+        self.assertEqual(self.cb.jobs, {})
+        self.assertEqual([name for name in schedule.schedule.events
+                          if name.startswith('TrelloMon.job.')], [])
+
+    def testMetrics(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.networks('net1')
+        self.cb.check_trello()
+        self.assertRegexp('cyclestats', r'cycle: 1, .*http: 2 requests, '
+                          r'\d+ms avg, 0 errors; cache hit rate: 0%; '
+                          r'messages: 5')
+        self.assertRegexp('cyclestats card_fetch', r'^list=list1: 1, ')
+        text = self.cb.prometheus()
+        for line in ['trellomon_phase_seconds_count{channel="#a",'
+                     'entry="new",phase="filter"} 1',
+                     'trellomon_http_requests_total{endpoint="lists/cards",'
+                     'method="GET",status="200"} 1',
+                     'trellomon_messages_total{channel="#a",network="net1"} 5',
+                     'trellomon_cache_misses 2']:
+            self.assertTrue(line in text.split('\n'), line)
+        self.cb.setRegistryValue('metricsFile', 'test.prom')
+        self.expire()
+        self.cb.check_trello()
+        with open(conf.supybot.directories.data.dirize('test.prom')) as f:
+            self.assertTrue('trellomon_cache_hits 1\n' in f.read())
+        # a request that times out is counted next to the answered ones
+        self.cb.client.retries = 0
+        self.cb.client.timeout = 0.2
+        self.stub.latency = 0.5
+        self.expire()
+        self.cb.check_trello()
+        self.stub.latency = 0
+        self.assertRegexp('cyclestats', r'http: 4 requests, .* 1 errors')
+        self.assertIn('trellomon_http_requests_total{endpoint="lists/cards",'
+                      'method="GET",status="error"} 1',
+                      self.cb.prometheus().split('\n'))
+
+    def testStartupDoesNotWait(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.monitor('other', 'list3', ['#a'])
+        self.cb.cache.clear()
+        self.stub.latency = 1
+        start = time.time()
+        self.assertNotError('reload TrelloMon')
+        self.assertTrue(time.time() - start < 0.5, time.time() - start)
+        self.cb = self.irc.getCallback('TrelloMon')
+        # the board links arrive in the background, in parallel
+        self.cb.resolver.join(5)
+        self.assertTrue(time.time() - start < 2, time.time() - start)
+        self.assertEqual(self.cb.registryValue('lists.other.url'),
+                         'https://trello.com/b/bboard2')
+        # and are cached for the next load
+        self.assertNotError('reload TrelloMon')
+        self.assertEqual(self.irc.getCallback('TrelloMon').resolver, None)
+
+    def testCardsCommand(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.networks('net1')
+        self.assertRegexp('cards new', 'not been fetched yet')
+        self.cb.check_trello()
+        self.stub.reset()
+        self.assertRegexp('cards new label:compute',
+                          r'^3 of 5 cards in new: Card 0 of list1 -- \S+ \| '
+                          r'Card 2 of list1 -- \S+ \| Card 4 of list1')
+        self.assertRegexp('cards new DFG:Network', r'^2 of 5 .*Card 1.*Card 4')
+        self.assertRegexp('cards new label:compute DFG:Network DFG:Storage',
+                          r'^2 of 5 .*Card 2.*Card 4')
+        self.assertRegexp('cards new "card 3"', r'^1 of 5 .*Card 3 of list1')
+        self.assertRegexp('cards new label:block nothing', 'no matching cards')
+        self.assertError('cards unknown')
+        self.assertEqual(self.stub.requests, [])
+        # others only see lists reported to a channel they share with us
+        stranger = 'stranger!user@__no_testcap__'
+        self.assertRegexp('cards new', 'not reported to any channel',
+                          frm=stranger)
+        self.irc.state.channels['#b'] = irclib.ChannelState()
+        self.irc.state.channels['#b'].addUser('stranger')
+        self.assertRegexp('cards new', 'not reported to any channel',
+                          frm=stranger)
+        self.irc.state.channels['#a'] = irclib.ChannelState()
+        self.irc.state.channels['#a'].addUser('stranger')
+        self.assertRegexp('cards new', r'^5 of 5 cards in new', frm=stranger)
+
+    def testConcurrentFetchKeepsOrder(self):
+        listids = ['slow%d' % n for n in range(4)]
+        for listid in listids:
+            self.stub.add_board('board-' + listid, {listid: 2})
+        self.stub.latency = 0.2
+        client = TrelloClient('key', 'token', self.stub.url, concurrency=4)
+        start = time.time()
+        snapshot = client.fetch_lists(list(reversed(listids)) + listids)
+        elapsed = time.time() - start
+        client.close()
+        self.assertEqual(list(snapshot), list(reversed(listids)))
+        self.assertEqual(client.requests, 8)
+        # two rounds of requests rather than eight in a row
+        self.assertTrue(elapsed < 1.0, elapsed)
+
+    def testRateLimiter(self):
+        limiter = RateLimiter(limit=3, period=0.5)
+        start = time.time()
+        for i in range(4):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.45)
+
+    def testRetryBackoff(self):
+        client = TrelloClient('key', 'token', self.stub.url, backoff=0.01)
+        self.stub.fail(2, 429, retry_after=0)
+        self.assertEqual(len(client.get('lists/list1/cards')), 5)
+        self.assertEqual((client.requests, client.retried), (3, 2))
+        client.retries = 1
+        self.stub.fail(3, 503)
+        self.assertRaises(requests.HTTPError, client.get, 'lists/list1/cards')
+        self.assertRegexp('trellostats', 'requests: 0, retried: 0')
+        # the budget headers pause further requests
+        self.stub.budget = 1
+        client.get('lists/list2')
+        self.assertEqual(client.budget, {'key': 0, 'token': 0})
+        self.assertTrue(client.paused_until > time.time() + 9)
+        client.close()
+
+    def testInflightCap(self):
+        self.stub.latency = 0.1
+        client = TrelloClient('key', 'token', self.stub.url, concurrency=2)
+        threads = [threading.Thread(target=client.get, args=('lists/list1',))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(self.stub.max_inflight, 2)
+
+    def testLastGoodSnapshot(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.monitor('other', 'list3', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 7)
+        # trello is down: the cycle completes from the last good cards
+        self.cb.client.backoff = 0.001
+        self.stub.fail(1000, 500)
+        del ircs[0].msgs[:]
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 7)
+        self.assertEqual(self.cb.client.stale, ['list1', 'list3'])
+        self.assertRegexp('trellostats', 'failed: 2')
+        self.assertEqual(self.cb.client.fetch_lists(['list1']).stale,
+                         ['list1'])
+        self.stub.failures = []
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(self.cb.client.stale, [])
+        self.assertEqual(self.cb.client.fetch_lists(['list1']).stale, [])
+
+    def testStatePersists(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.cb.setRegistryValue('lists.new.diff', True, channel='#a')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 5)
+        # a new plugin instance carries on: nothing is due, and the diff
+        # is against the cards it announced before
+        self.assertNotError('reload TrelloMon')
+        self.cb = self.irc.getCallback('TrelloMon')
+        self.cb.resolver.join(5)
+        state = self.cb.states[('net1', 'new', '#a')]
+        self.assertEqual((state.count, len(state.cards)), (5, 5))
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(self.stub.requests, [])
+        self.stub.rename_card(self.stub.lists['list1']['cards'][0]['id'],
+                              'renamed')
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 6)
+        self.assertTrue(' CHANGED: ' in ircs[0].msgs[-1].args[1])
+
+    def testCustomFieldsCached(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.networks('net1')
+        self.cb.check_trello()
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(self.stub.requests, ['/1/lists/list1/cards'])
+        self.assertRegexp('cachestats', 'cache hits: [1-9]')
+        # reloadtrello forgets everything
+        self.assertNotError('reloadtrello')
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertIn('/1/boards/board1/customFields', self.stub.requests)
+
+    def testCachePersists(self):
+        filename = conf.supybot.directories.data.dirize('test.cache.json')
+        cache = TTLCache(60)
+        cache.set('board:list1', 'board1')
+        cache.save(filename)
+        cache = TTLCache(60)
+        cache.load(filename)
+        self.assertEqual(cache.get('board:list1'), 'board1')
+        cache.ttl = -1
+        cache.set('board:list1', 'board1')
+        self.assertEqual(cache.get('board:list1'), None)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1,
+                                         'entries': 1})
+
+    def testIncrementalSync(self):
+        client = TrelloClient('key', 'token', self.stub.url,
+                              cache=TTLCache(60))
+        sync = BoardSync(client)
+        sync.fetch_lists(['list1', 'list2'])
+        # a quiet board costs one request
+        self.stub.reset()
+        sync.fetch_lists(['list1', 'list2'])
+        self.assertEqual(self.stub.requests, ['/1/boards/board1/actions'])
+        cards = [card['id'] for card in self.stub.lists['list1']['cards']]
+        self.stub.create_card('list1', 'brand new', labels=['Blocker'])
+        self.stub.move_card(cards[0], 'list2')
+        self.stub.archive_card(cards[1])
+        self.stub.rename_card(cards[2], 'renamed')
+        self.stub.add_label(cards[2], 'Blocker')
+        self.stub.remove_label(cards[3], 'Blocker')
+        self.stub.set_custom_field(cards[3], 'DFG', 'Storage')
+        self.stub.set_custom_field(cards[3], 'RCA', 'fixed')
+        self.stub.reset()
+        incremental = sync.fetch_lists(['list1', 'list2'])
+        self.assertEqual(self.stub.requests, ['/1/boards/board1/actions',
+                                              '/1/cards/list1-c20'])
+        full = client.fetch_lists(['list1', 'list2'])
+        for listid in ('list1', 'list2'):
+            self.assertEqual(sorted(c['id'] for c in incremental[listid][0]),
+                             sorted(c['id'] for c in full[listid][0]))
+            for (new, old) in zip(sorted(incremental[listid][0],
+                                         key=lambda c: c['id']),
+                                  sorted(full[listid][0],
+                                         key=lambda c: c['id'])):
+                for key in ('name', 'idList', 'labels', 'customFieldItems'):
+                    self.assertEqual(new[key], old[key])
+
+    def testIncrementalResync(self):
+        client = TrelloClient('key', 'token', self.stub.url,
+                              cache=TTLCache(60))
+        sync = BoardSync(client, resync=0)
+        sync.fetch_lists(['list1'])
+        self.stub.reset()
+        sync.fetch_lists(['list1'])
+        self.assertIn('/1/lists/list1/cards', self.stub.requests)
+        # trello is down: the cards of the last load, noted as stale
+        client.retries = 0
+        self.stub.fail(1000, 500)
+        snapshot = sync.fetch_lists(['list1'])
+        self.assertEqual(len(snapshot['list1'][0]), 5)
+        self.assertEqual(snapshot.stale, ['list1'])
+
+    def testResyncKeepsOtherLists(self):
+        client = TrelloClient('key', 'token', self.stub.url,
+                              cache=TTLCache(60))
+        sync = BoardSync(client, resync=3600)
+        sync.fetch_lists(['list1', 'list2'])
+        # only list1 is due when the resync comes round
+        sync.boards['board1'].loaded -= 3600
+        sync.fetch_lists(['list1'])
+        for listid in ['list2', 'list1', 'list2']:
+            self.stub.reset()
+            self.assertIn(listid, sync.fetch_lists([listid]))
+            self.assertEqual(self.stub.requests, ['/1/boards/board1/actions'])
+
+    def testPushDuringLoad(self):
+        client = TrelloClient('key', 'token', self.stub.url,
+                              cache=TTLCache(60))
+        sync = BoardSync(client, pushed=True)
+        cardid = self.stub.lists['list1']['cards'][0]['id']
+        self.stub.latency = 0.2
+        thread = threading.Thread(target=sync.fetch_lists, args=(['list1'],))
+        thread.start()
+        timeout = time.time() + 5
+        while time.time() < timeout and 'board1' not in sync.loading:
+            time.sleep(0.01)
+        # applied to the copy being loaded rather than lost with the old one
+        self.assertTrue(sync.push({'id': 'ffff', 'type': 'deleteCard',
+                                   'data': {'board': {'id': 'board1'},
+                                            'card': {'id': cardid}}}))
+        thread.join()
+        self.stub.latency = 0
+        cards = sync.fetch_lists(['list1'])['list1'][0]
+        self.assertEqual(len(cards), 4)
+        self.assertNotIn(cardid, [card['id'] for card in cards])
+
+    def post_webhook(self, body, secret='s3cret'):
+        '''POST body to the plugin's webhook endpoint the way trello does,
+        returning the response status'''
+        url = self.cb.registryValue('webhookUrl')
+        digest = hmac.new(secret.encode('utf-8'),
+                          body.encode('utf-8') + url.encode('utf-8'),
+                          hashlib.sha1).digest()
+        request = ('POST /trellomon/ HTTP/1.1\r\n'
+                   'Content-Type: application/json\r\n'
+                   'Content-Length: %d\r\n'
+                   'X-Trello-Webhook: %s\r\n\r\n%s' %
+                   (len(body), base64.b64encode(digest).decode(), body))
+        handler = TestRequestHandler(io.BytesIO(request.encode('utf-8')),
+                                     io.BytesIO())
+        return handler._response
+
+    def testWebhook(self):
+        self.cb.setRegistryValue('webhook', True)
+        self.cb.setRegistryValue('webhookSecret', 's3cret')
+        self.cb.setRegistryValue('webhookUrl', 'http://bot/trellomon/')
+        self.cb.reload_trello()
+        self.cb.webhook = TrelloWebhook(self.cb)
+        httpserver.hook('trellomon', self.cb.webhook)
+        self.monitor('new', 'list1', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 5)
+        self.assertRegexp('registerwebhooks',
+                          'registered webhooks for 1 boards')
+        self.assertEqual(self.stub.webhooks[0]['callbackURL'],
+                         'http://bot/trellomon/')
+        card = self.stub.create_card('list1', 'pushed')
+        payload = self.stub.webhook_payload(self.stub.actions[-1],
+                                            'http://bot/trellomon/')
+        self.assertEqual(self.post_webhook(payload, 'wrong'), 401)
+        self.assertEqual(self.post_webhook(payload), 200)
+        # restarting the agent leaves the endpoint and the client alone
+        self.assertNoResponse('startagent', 1)
+        self.assertTrue(self.cb.jobs)
+        self.assertNoResponse('killagent', 1)
+        self.assertEqual(self.cb.jobs, {})
+        self.assertEqual(self.post_webhook(payload), 200)
+        # the next cycle reports the new card without asking trello
+        self.stub.reset()
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(len(ircs[0].msgs), 11)
+        self.assertIn('pushed', ircs[0].msgs[-1].args[1])
+        # trello fails the card lookup: still a 200, and a full reload
+        self.cb.client.retries = 0
+        self.stub.create_card('list1', 'lost')
+        payload = self.stub.webhook_payload(self.stub.actions[-1],
+                                            'http://bot/trellomon/')
+        self.stub.fail(1000, 500)
+        self.assertEqual(self.post_webhook(payload), 200)
+        with self.stub._lock:
+            del self.stub.failures[:]
+        self.stub.reset()
+        self.expire()
+        self.cb.check_trello()
+        self.assertIn('/1/lists/list1/cards', self.stub.requests)
+        self.assertIn('lost', ircs[0].msgs[-1].args[1])
+
+    def testRenderTemplates(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.cb.setRegistryValue('lists.new.precustom', '${DFG}/${Nope}')
+        self.cb.setRegistryValue('lists.new.postcustom', 'RCA: ${RCA} ')
+        self.cb.setRegistryValue('lists.new.AlertMessage', 'ALERT',
+                                 channel='#a')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual(ircs[0].msgs[0].args[1],
+                         'ALERT Compute/N/A Card 0 of list1 -- '
+                         'https://trello.com/c/slist1-c0 RCA: rca 0 ')
+        card = self.stub.lists['list1']['cards'][1]
+        card['customFieldItems'] = []
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(ircs[0].msgs[6].args[1],
+                         'ALERT None/N/A Card 1 of list1 -- '
+                         'https://trello.com/c/slist1-c2 RCA: None ')
+
+    def testCustomFieldFilter(self):
+        self.monitor('new', 'list1', ['#a', '#b'])
+        self.cb.setRegistryValue('lists.new.custom_field_filter',
+                                 'DFG:Network,Blocker:true', channel='#a')
+        self.cb.setRegistryValue('lists.new.custom_field_filter',
+                                 'Nope:x', channel='#b')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual([m.args[1].split('Card ')[1][0]
+                          for m in ircs[0].msgs], ['0', '1', '2', '4'])
+        (cards, fields) = self.cb.client.fetch_list('list3')
+        self.assertFalse(self.cb.check_custom_filter(cards[0], 'RCA:rca 0',
+                                                     fields))
+        self.assertTrue(self.cb.check_custom_filter(cards[1], 'RCA:rca 0',
+                                                    fields))
+        self.assertFalse(self.cb.check_custom_filter(cards[1], '', fields))
+        self.assertEqual(self.cb.get_custom_field_value(
+            cards[1]['customFieldItems'][1], fields), 'rca 1')
+
+    def testRegistryReadsIndependentOfCards(self):
+        self.monitor('new', 'list1', ['#a', '#b'])
+        self.networks('net1')
+        calls = []
+        registryValue = self.cb.registryValue
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return registryValue(*args, **kwargs)
+        self.cb.registryValue = counting
+        try:
+            self.cb.check_trello()
+            few = len(calls)
+            for n in range(50):
+                self.stub.add_card('list1', 'more %d' % n)
+            del calls[:]
+            self.expire()
+            self.cb.check_trello()
+            self.assertEqual(len(calls), few)
+        finally:
+            del self.cb.registryValue
+
+    def testLabelFilter(self):
+        self.monitor('new', 'list1', ['#a', '#b'])
+        self.cb.setRegistryValue('lists.new.labels', 'compute',
+                                 channel='#a')
+        self.cb.setRegistryValue('labels', 'nothing,', channel='#a')
+        self.cb.setRegistryValue('lists.new.labels', 'block,COMP',
+                                 channel='#b')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual([(m.args[0], m.args[1].split('Card ')[1][0])
+                          for m in ircs[0].msgs],
+                         [('#a', '0'), ('#a', '2'), ('#a', '4')] +
+                         [('#b', str(n)) for n in range(5)])
+        labels = [{'name': 'DFG-Network'}, {'name': 'Triaged'}]
+        self.assertTrue(self.cb.check_labels(labels, ['x', 'triage']))
+        self.assertFalse(self.cb.check_labels(labels, ['compute']))
+        self.assertFalse(self.cb.check_labels(labels, []))
+
+    def testDiffAlerts(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.cb.setRegistryValue('lists.new.diff', True, channel='#a')
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 5)
+        cards = [card['id'] for card in self.stub.lists['list1']['cards']]
+        self.stub.create_card('list1', 'brand new')
+        self.stub.rename_card(cards[1], 'renamed')
+        self.stub.archive_card(cards[2])
+        # not shown by the templates, so not a change
+        self.stub.set_custom_field(cards[3], 'Blocker', 'true')
+        del ircs[0].msgs[:]
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual([m.args[1].split(' -- ')[0] for m in ircs[0].msgs],
+                         [' CHANGED: DFG: Network renamed',
+                          ' NEW: DFG: None brand new',
+                          ' REMOVED: Card 2 of list1'])
+        # nothing changed, nothing said
+        del ircs[0].msgs[:]
+        self.expire()
+        self.cb.check_trello()
+        self.assertEqual(ircs[0].msgs, [])
+        # unless a digest is due
+        self.cb.setRegistryValue('lists.new.digest', 1, channel='#a')
+        self.expire(600)
+        self.cb.check_trello()
+        self.assertEqual(len(ircs[0].msgs), 5)
+
+    def testOutboxCoalescesAndPaces(self):
+        self.assertEqual(pack(['aa', 'bb', 'cc', 'd' * 10], 8),
+                         ['aa | bb', 'cc', 'd' * 10])
+        self.stub.add_board('board3', {'big': 40})
+        self.monitor('big', 'big', ['#a'])
+        self.cb.setRegistryValue('coalesce', True)
+        self.cb.setRegistryValue('sendburst', 2)
+        self.cb.setRegistryValue('sendbacklog', 3)
+        ircs = self.networks('net1')
+        self.cb.check_trello()
+        msgs = ircs[0].msgs
+        # two packed messages right away, each within an IRC line
+        self.assertEqual(len(msgs), 2)
+        for msg in msgs:
+            self.assertTrue(' | ' in msg.args[1])
+            self.assertTrue(len(str(msg)) <= 412, str(msg))
+        self.assertRegexp('queuestats', r'queued: 1, sent: 2, dropped: [1-9]'
+                          r'.*net1 #a: 1')
+        # the rest of the backlog was summarised
+        self.cb.outbox.flush(time.time() + 2)
+        self.assertEqual(len(msgs), 3)
+        self.assertRegexp('queuestats', 'queued: 0, sent: 3')
+        self.assertTrue(msgs[2].args[1].endswith('more messages dropped'))
+
+    def testTokenBucket(self):
+        sent = []
+        outbox = OutQueue(lambda irc, chan, text: sent.append(text),
+                          rate=1, burst=2, coalesce=False)
+        irc = FakeIrc('net1', ['#a'])
+        outbox.put(irc, '#a', ['one', 'two', 'three'])
+        outbox.put(FakeIrc('net2', ['#a']), '#a', ['other'])
+        now = time.time()
+        wait = outbox.flush(now)
+        self.assertEqual(sent, ['one', 'two', 'other'])
+        self.assertTrue(0 < wait <= 1, wait)
+        self.assertEqual(outbox.flush(now + 1), None)
+        self.assertEqual(sent[-1], 'three')
+
+    def testShardMode(self):
+        self.monitor('new', 'list1', ['#a'])
+        self.monitor('other', 'list3', ['#a'])
+        ircs = self.networks('net1')
+        self.cb.setRegistryValue('shardFile', 'shards.db')
+        self.cb.setRegistryValue('shardName', 'me')
+        self.cb.shards = self.cb.shard_store()
+        # another bot got list1 first and published its cards
+        other = ShardStore(self.cb.shards.filename, 'other', lease=60)
+        self.assertEqual(other.claim(['list1']), set(['list1']))
+        other.publish({'list1': ([{'id': 'p1', 'name': 'Published',
+                                   'shortUrl': 'https://trello.com/c/p1',
+                                   'labels': [], 'customFieldItems': []}],
+                                 [])})
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/1/boards/board2/customFields',
+                          '/1/lists/list3/cards'])
+        self.assertEqual(len(ircs[0].msgs), 3)
+        self.assertIn('Published', ircs[0].msgs[0].args[1])
+        self.assertEqual(other.owners(), {'list1': 'other', 'list3': 'me'})
+        # what we fetched is there for the other bot
+        (cards, fields) = other.read(['list3'])['list3']
+        self.assertEqual(len(cards), 2)
+        self.assertEqual(fields[0]['name'], 'DFG')
+        # a copy older than the list's interval is not reported as current
+        other.publish({'list1': ([{'id': 'p1', 'name': 'Old',
+                                   'shortUrl': 'https://trello.com/c/p1',
+                                   'labels': [], 'customFieldItems': []}],
+                                 [])}, now=time.time() - 7200)
+        del ircs[0].msgs[:]
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertIn('/1/lists/list1/cards', self.stub.requests)
+        self.assertEqual(len(ircs[0].msgs), 7)
+        self.assertNotIn('Old', ' '.join(m.args[1] for m in ircs[0].msgs))
+        self.assertEqual(other.owners()['list1'], 'other')
+        # the other bot stops, so list1 is ours once its lease is gone
+        other.release()
+        self.expire()
+        self.stub.reset()
+        self.cb.check_trello()
+        self.assertIn('/1/lists/list1/cards', self.stub.requests)
+        self.assertEqual(self.cb.shards.owned, set(['list1', 'list3']))
+        self.assertResponse('shardstats', 'me (me): list1, list3')
+
+    def testShardProcesses(self):
+        filename = conf.supybot.directories.data.dirize('shards.db')
+        keys = ['list%d' % n for n in range(12)]
+        here = os.path.dirname(os.path.abspath(__file__))
+        workers = dict((name, subprocess.Popen(
+            [sys.executable, '-c', SHARD_WORKER, here, filename, name, '1',
+             ','.join(keys)])) for name in ('a', 'b', 'c'))
+        try:
+            watcher = ShardStore(filename, 'watcher', lease=1)
+            # every list has one owner, and every worker got some
+            owners = wait_until(lambda: (lambda owners: owners if len(
+                owners) == len(keys) and set(owners.values()) == set('abc')
+                else None)(watcher.owners()))
+            self.assertEqual(sorted(owners), sorted(keys))
+            published = wait_until(lambda: (lambda found: found if len(
+                found) == len(keys) else None)(watcher.read(keys)))
+            for key in keys:
+                self.assertEqual(published[key][0][0]['name'], owners[key])
+            # a worker dies: its lists move to the others once its leases
+            # run out
+            workers['a'].kill()
+            workers['a'].wait()
+            owners = wait_until(lambda: (lambda owners: owners if len(
+                owners) == len(keys) and 'a' not in owners.values()
+                else None)(watcher.owners()))
+            self.assertEqual(set(owners.values()), set('bc'))
+            self.assertEqual(watcher.members(), ['b', 'c'])
+            wait_until(lambda: (lambda found: all(
+                found.get(key) and found[key][0][0]['name'] != 'a'
+                for key in keys))(watcher.read(keys)))
+        finally:
+            for worker in workers.values():
+                if worker.poll() is None:
+                    worker.kill()
+                    worker.wait()
+
+    def testStreamedCards(self):
+        cards = [{'id': 'c%d' % n, 'name': u'caf\xe9 %d' % n, 'pos': n}
+                 for n in range(50)]
+        data = json.dumps(cards).encode('utf-8')
+        for size in (1, 7, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(iter_array(chunks)), cards)
+        self.assertRaises(ValueError, list, iter_array([data[:-20]]))
+        self.assertRaises(ValueError, list, iter_array([b'{"id": 1}']))
+        client = TrelloClient('key', 'token', self.stub.url)
+        (listcards, fields) = client.fetch_list('list1')
+        self.assertEqual(len(listcards), 5)
+        card = listcards[0]
+        self.assertFalse(isinstance(card, dict))
+        self.assertEqual(card['idList'], 'list1')
+        self.assertEqual(card.get('closed', 'open'), 'open')
+        self.assertFalse('closed' in card)
+        self.assertRaises(KeyError, card.__getitem__, 'closed')
+        self.assertEqual(set(card['customFieldItems'][0]),
+                         set(['idCustomField', 'idValue']))
+        # one dict per label, whatever the number of cards carrying it
+        blockers = [label for each in listcards for label in each['labels']
+                    if label['name'] == 'Blocker']
+        self.assertTrue(len(blockers) > 1)
+        self.assertTrue(all(label is blockers[0] for label in blockers))
+        card['name'] = 'renamed'
+        self.assertEqual(card['name'], 'renamed')
+        client.close()
+
+
+@unittest.skipUnless(os.environ.get('TRELLOMON_BENCHMARK'),
+                     'set TRELLOMON_BENCHMARK to run the benchmarks')
+class TrelloMonBenchmark(TrelloMonCase):
+    '''what a check cycle of the whole plugin costs as lists, cards,
+    channels and networks grow.  Runs against the stub, so offline:
+
+        TRELLOMON_BENCHMARK=1 supybot-test TrelloMon
+
+    TRELLOMON_BENCHMARK_LATENCY adds that many seconds to every stub
+    answer.'''
+
+    # (lists, cards per list, channels, networks)
+    SCENARIOS = [(1, 100, 1, 1), (4, 100, 1, 1), (16, 100, 1, 1),
+                 (4, 1000, 1, 1), (4, 100, 8, 1), (4, 100, 8, 4)]
+
+    def setup_scenario(self, n, lists, cards, channels, networks):
+        '''fresh plugin state, and lists of cards spread over boards of four
+        lists, reported to every channel of every network'''
+        self.forget_lists()
+        self.cb.states.clear()
+        self.cb.cache.clear()
+        self.cb.reload_trello()
+        boards = {}
+        for i in range(lists):
+            boards.setdefault('s%d-board%d' % (n, i // 4), {})[
+                's%d-list%d' % (n, i)] = cards
+        for (boardid, boardlists) in sorted(boards.items()):
+            self.stub.add_board(boardid, boardlists)
+        chans = ['#c%d' % i for i in range(channels)]
+        for i in range(lists):
+            self.monitor('s%d_%d' % (n, i), 's%d-list%d' % (n, i), chans)
+        world.ircs[:] = [FakeIrc('net%d' % i, chans)
+                         for i in range(networks)]
+
+    def cycle(self):
+        '''(seconds, requests, messages) of one check of every list'''
+        self.expire()
+        self.stub.reset()
+        for irc in world.ircs:
+            del irc.msgs[:]
+        start = time.time()
+        self.cb.check_trello()
+        return (time.time() - start, len(self.stub.requests),
+                sum(len(irc.msgs) for irc in world.ircs))
+
+    def testScaling(self):
+        self.stub.latency = float(
+            os.environ.get('TRELLOMON_BENCHMARK_LATENCY', 0))
+        self.cb.setRegistryValue('coalesce', True)
+        self.cb.setRegistryValue('sendbacklog', 10 ** 6)
+        self.cb.setRegistryValue('sendburst', 10 ** 9)
+        print('\ncheck_trello against the stub, %gs latency' %
+              self.stub.latency)
+        print('%5s %5s %5s %4s %8s %8s %5s %5s %9s %6s' % (
+            'lists', 'cards', 'chans', 'nets', 'cold s', 'warm s',
+            'reqs', 'warm', 'peak KiB', 'msgs'))
+        for (n, scenario) in enumerate(self.SCENARIOS):
+            self.setup_scenario(n, *scenario)
+            (cold, requests, messages) = self.cycle()
+            (warm, warm_requests, warm_messages) = self.cycle()
+            tracemalloc.start()
+            try:
+                self.cycle()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(messages, warm_messages)
+            print('%5d %5d %5d %4d %8.3f %8.3f %5d %5d %9d %6d' % (
+                scenario + (cold, warm, requests, warm_requests,
+                            peak // 1024, messages)))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
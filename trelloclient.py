@@ -0,0 +1,456 @@
+###
+# Copyright (c) 2017, Mike Burns
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Small Trello REST client used by the list monitor.  Kept free of any supybot
+imports so it can be driven directly by benchmark.py.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from .jsonstream import iter_array
+    from .metrics import Metrics
+    from .records import Card, compact_item
+except ImportError:
+    # imported as a top-level module by benchmark.py
+    from jsonstream import iter_array
+    from metrics import Metrics
+    from records import Card, compact_item
+
+TRELLO_URL = 'https://api.trello.com/1/'
+
+# Card fields needed by check_trello.  idBoard lets us find the board's custom
+# field definitions without an extra list lookup.
+CARD_FIELDS = 'name,shortLink,shortUrl,labels,idBoard,idList,pos'
+
+# Trello allows 100 requests per 10 seconds for each token
+RATE_LIMIT = 100
+RATE_PERIOD = 10
+
+# Answers worth another try: over the rate limit, or trello struggling
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Rate limit budget headers, for the api key and for the token
+BUDGET_HEADERS = ('key', 'token')
+
+# Bytes read at a time from a streamed response
+CHUNK_SIZE = 64 * 1024
+
+
+def endpoint(path):
+    '''a path without its ids, e.g. lists/<id>/cards -> lists/cards, for
+    labelling metrics'''
+    parts = path.strip('/').split('/')
+    return '/'.join(parts[:1] + parts[2:])
+
+
+def backoff(attempt, base, cap):
+    '''"full jitter" exponential backoff: a random wait up to base * 2 **
+    attempt seconds, at most cap'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Snapshot(dict):
+    '''{listid: (cards, custom_field_details)} as returned by fetch_lists,
+    with the lists served from an earlier fetch in stale'''
+
+    def __init__(self, stale=()):
+        dict.__init__(self)
+        self.stale = list(stale)
+
+
+class RateLimiter(object):
+    '''sliding window limiter: at most limit calls per period seconds'''
+
+    def __init__(self, limit=RATE_LIMIT, period=RATE_PERIOD):
+        self.limit = limit
+        self.period = period
+        self.calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''block until another call fits in the window'''
+        while True:
+            with self._lock:
+                now = time.time()
+                while self.calls and self.calls[0] <= now - self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.limit:
+                    self.calls.append(now)
+                    return
+                wait = self.calls[0] + self.period - now
+            time.sleep(wait)
+
+
+class TrelloClient(object):
+    '''Minimal Trello API wrapper that counts the requests it makes.
+
+    Requests go through one keep-alive session whose connection pool is
+    sized for the number of concurrent workers used by fetch_lists.  When a
+    cache (see cache.TTLCache) is given, board ids, board shortLinks and
+    custom field definitions are looked up there first.
+
+    429 and 5xx answers and connection errors are retried up to retries
+    times with jittered backoff, honouring Retry-After.  The rate limit
+    headers of every answer are kept in budget, and when trello says the
+    budget is spent, requests wait for the interval to pass.  At most
+    concurrency requests are in flight at once, whatever the caller.
+
+    Cards are returned as compact records (see records.Card), decoded from
+    the response one at a time.
+
+    Request counts and latencies, and the time spent on each fetch phase,
+    are recorded in metrics (see metrics.Metrics).
+
+    When at least board_threshold of the lists asked for are known to share
+    a board, the board's open cards are fetched in one request and split by
+    list.  Boards are learnt from the cards of earlier fetches, so this costs
+    no extra lookups.  A list that comes back empty is fetched on its own,
+    in case it has moved.  0 turns it off.'''
+
+    def __init__(self, key, token, baseurl=TRELLO_URL, concurrency=4,
+                 limiter=None, cache=None, retries=3, backoff=0.5,
+                 backoff_cap=10, timeout=30, metrics=None,
+                 board_threshold=2):
+        self.key = key
+        self.token = token
+        self.baseurl = baseurl.rstrip('/') + '/'
+        self.concurrency = concurrency
+        self.limiter = limiter or RateLimiter()
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.board_threshold = board_threshold
+        # {list id: board id} of every list seen so far
+        self.list_boards = {}
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.last_error = None
+        self.budget = {}
+        self.paused_until = 0
+        # last good (cards, custom fields) of every list, and the lists
+        # served from there by the latest fetch_lists
+        self.snapshots = {}
+        self.stale = []
+        self._lock = threading.Lock()
+        self._inflight = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency,
+                              pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, path, params):
+        '''make a request with the auth options, retrying what is worth
+        retrying, and return the json'''
+        return self.respond(method, path, params).json()
+
+    def respond(self, method, path, params, stream=False):
+        '''make a request with the auth options, retrying what is worth
+        retrying, and return the successful response.  With stream, the body
+        is left to be read and the response must be closed.'''
+        params.update({'key': self.key, 'token': self.token})
+        attempt = 0
+        while True:
+            wait = self.paused_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.limiter.acquire()
+            with self._lock:
+                self.requests += 1
+            start = time.time()
+            try:
+                with self._inflight:
+                    r = self.session.request(method, self.baseurl + path,
+                                             params=params, stream=stream,
+                                             timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(method, path, 'error', start)
+                if attempt >= self.retries:
+                    raise
+                wait = None
+            else:
+                self.record(method, path, str(r.status_code), start)
+                self.read_budget(r.headers)
+                if r.status_code not in RETRY_STATUS or \
+                        attempt >= self.retries:
+                    if not r.ok:
+                        r.close()
+                    r.raise_for_status()
+                    return r
+                wait = r.headers.get('Retry-After')
+                r.close()
+            try:
+                wait = float(wait)
+            except (TypeError, ValueError):
+                wait = backoff(attempt, self.backoff, self.backoff_cap)
+            with self._lock:
+                self.retried += 1
+            attempt += 1
+            time.sleep(wait)
+
+    def record(self, method, path, status, start):
+        '''count a request and its latency'''
+        self.metrics.observe('trellomon_http_request_seconds',
+                             time.time() - start, endpoint=endpoint(path))
+        self.metrics.count('trellomon_http_requests_total', method=method,
+                           endpoint=endpoint(path), status=status)
+
+    def read_budget(self, headers):
+        '''note the rate limit budget left, and pause when it is spent'''
+        for name in BUDGET_HEADERS:
+            remaining = headers.get('x-rate-limit-api-%s-remaining' % name)
+            if remaining is None:
+                continue
+            self.budget[name] = int(remaining)
+            if int(remaining) <= 0:
+                interval = headers.get(
+                    'x-rate-limit-api-%s-interval-ms' % name,
+                    RATE_PERIOD * 1000)
+                self.paused_until = max(self.paused_until,
+                                        time.time() + int(interval) / 1000.0)
+
+    def get(self, path, **params):
+        '''GET <baseurl><path> with the auth options and return the json'''
+        return self.request('GET', path, params)
+
+    def get_array(self, path, convert, **params):
+        '''GET a json array and return [convert(element)], decoding the
+        response one element at a time'''
+        r = self.respond('GET', path, params, stream=True)
+        try:
+            return [convert(element) for element
+                    in iter_array(r.iter_content(CHUNK_SIZE))]
+        finally:
+            r.close()
+
+    def attempt(self, func, *args):
+        '''func(*args), or None when trello could not be reached.  The
+        failure is counted and kept in last_error.'''
+        try:
+            return func(*args)
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                self.failures += 1
+                self.last_error = e
+            return None
+
+    def cached(self, key, func):
+        '''func() through the cache, if there is one'''
+        if self.cache is None:
+            return func()
+        return self.cache.fetch(key, func)
+
+    def post(self, path, **params):
+        '''POST <baseurl><path> with the auth options and return the json'''
+        return self.request('POST', path, params)
+
+    def map(self, func, items):
+        '''func applied to every item on up to concurrency threads, results
+        in the order of items'''
+        items = list(items)
+        if self.concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(min(self.concurrency, len(items))) as pool:
+            return list(pool.map(func, items))
+
+    def get_list_board(self, listid):
+        '''return the id of the board containing listid'''
+        with self.metrics.timer('trellomon_phase_seconds',
+                                phase='board_lookup', list=listid):
+            boardid = self.cached('board:' + listid, lambda: self.get(
+                'lists/' + listid, fields='idBoard')['idBoard'])
+        self.list_boards[listid] = boardid
+        return boardid
+
+    def get_list_board_shortlink(self, listid):
+        '''return the shortLink of the board containing listid'''
+        return self.cached('shortLink:' + listid, lambda: self.get(
+            'lists/' + listid + '/board', fields='shortLink')['shortLink'])
+
+    def get_board_custom_fields(self, boardid):
+        '''return the custom field definitions of a board'''
+        with self.metrics.timer('trellomon_phase_seconds',
+                                phase='custom_field_fetch', board=boardid):
+            return self.cached('customFields:' + boardid, lambda: self.get(
+                'boards/' + boardid + '/customFields'))
+
+    def create_webhook(self, model, callback, description='TrelloMon'):
+        '''ask trello to POST the actions of model to callback'''
+        return self.post('webhooks', idModel=model, callbackURL=callback,
+                         description=description)
+
+    def get_card(self, card):
+        '''return a single card with its customFieldItems'''
+        return Card(self.get('cards/' + card, fields=CARD_FIELDS,
+                             customFieldItems='true'))
+
+    def get_card_custom_fields(self, card):
+        '''return the customFieldItems of a single card'''
+        return self.get('cards/' + card,
+                        customFieldItems='true')['customFieldItems']
+
+    def get_list_cards(self, listid, percard=False):
+        '''return the cards of a list with their customFieldItems attached.
+
+        Trello returns the items inline with the cards, so this is a single
+        request whatever the list size.  The per-card lookup is only used
+        when the response does not carry them, or when percard is set.'''
+        params = {'fields': CARD_FIELDS}
+        if not percard:
+            params['customFieldItems'] = 'true'
+        with self.metrics.timer('trellomon_phase_seconds',
+                                phase='card_fetch', list=listid):
+            cards = self.get_array('lists/' + listid + '/cards', Card,
+                                   **params)
+            for card in cards:
+                if 'customFieldItems' not in card:
+                    card['customFieldItems'] = [
+                        compact_item(item) for item
+                        in self.get_card_custom_fields(card['shortLink'])]
+        return cards
+
+    def get_board_cards(self, boardid, listids):
+        '''return {listid: cards} for some lists of a board, from a single
+        request for all the open cards of the board'''
+        with self.metrics.timer('trellomon_phase_seconds',
+                                phase='board_fetch', board=boardid):
+            cards = self.get_array('boards/' + boardid + '/cards', Card,
+                                   filter='open', fields=CARD_FIELDS,
+                                   customFieldItems='true')
+        result = dict((listid, []) for listid in listids)
+        for card in cards:
+            if card.get('idList') in result:
+                result[card['idList']].append(card)
+        for listcards in result.values():
+            listcards.sort(key=lambda card: card.get('pos', 0))
+        return result
+
+    def group_by_board(self, listids):
+        '''{board id: [list ids]} of the lists whose board is known'''
+        byboard = {}
+        for listid in listids:
+            boardid = self.list_boards.get(listid)
+            if boardid is not None:
+                byboard.setdefault(boardid, []).append(listid)
+        return byboard
+
+    def fetch_list(self, listid, percard=False):
+        '''return (cards, custom_field_details) for a single list'''
+        return self.fetch_lists([listid], percard)[listid]
+
+    def fetch_lists(self, listids, percard=False):
+        '''return {listid: (cards, custom_field_details)} in listids order.
+
+        Every distinct list is fetched once, and lists that share a board
+        share one custom field request.  The board id is read from the cards,
+        so an empty list does not need the custom fields at all.  Lists, and
+        then boards, are fetched concurrently.
+
+        A list that cannot be fetched is served from its last good snapshot
+        and noted in the stale of the result (and of the client, for the
+        latest call), or left out when there is none.'''
+        listids = [listid for (i, listid) in enumerate(listids)
+                   if listid and listid not in listids[:i]]
+        bulk = {}
+        if self.board_threshold and not percard:
+            bulk = dict((boardid, lists) for (boardid, lists)
+                        in self.group_by_board(listids).items()
+                        if len(lists) >= self.board_threshold)
+        inbulk = set(listid for lists in bulk.values() for listid in lists)
+
+        def fetch(job):
+            (kind, key) = job
+            if kind == 'board':
+                return self.attempt(self.get_board_cards, key, bulk[key])
+            return self.attempt(self.get_list_cards, key, percard)
+        jobs = [('board', boardid) for boardid in bulk] + \
+            [('list', listid) for listid in listids if listid not in inbulk]
+        fetched = {}
+        for (job, result) in zip(jobs, self.map(fetch, jobs)):
+            if job[0] == 'list':
+                fetched[job[1]] = result
+            else:
+                for listid in bulk[job[1]]:
+                    fetched[listid] = None if result is None \
+                        else result[listid]
+        # a list without cards on its board may have moved to another
+        # board, or be gone: forget its board and ask for it on its own
+        empty = [listid for listid in inbulk if fetched[listid] == []]
+        for listid in empty:
+            self.list_boards.pop(listid, None)
+        fetched.update(zip(empty, self.map(
+            lambda listid: self.attempt(self.get_list_cards, listid),
+            empty)))
+        cards = [fetched[listid] for listid in listids]
+        listboards = []
+        for (listid, listcards) in zip(listids, cards):
+            boardid = None
+            if listcards:
+                boardid = listcards[0].get('idBoard') or \
+                    self.attempt(self.get_list_board, listid)
+                if boardid is not None:
+                    self.list_boards[listid] = boardid
+            listboards.append(boardid)
+        boardids = [boardid for (i, boardid) in enumerate(listboards)
+                    if boardid and boardid not in listboards[:i]]
+        boards = dict(zip(boardids, self.map(
+            lambda boardid: self.attempt(self.get_board_custom_fields,
+                                         boardid), boardids)))
+        result = Snapshot()
+        for (listid, listcards, boardid) in zip(listids, cards, listboards):
+            if listcards is None or (listcards and (
+                    boardid is None or boards[boardid] is None)):
+                if listid in self.snapshots:
+                    result[listid] = self.snapshots[listid]
+                    result.stale.append(listid)
+                continue
+            result[listid] = self.snapshots[listid] = (
+                listcards, boards[boardid] if listcards else [])
+        self.stale = result.stale
+        return result
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: